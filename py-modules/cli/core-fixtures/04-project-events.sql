@@ -0,0 +1,30 @@
+/** Notify long-running workers when projects change, so they can drop
+  cached connection parameters (see mapboard.core.registry) */
+
+CREATE OR REPLACE FUNCTION public.notify_project_change()
+  RETURNS trigger AS
+$$
+BEGIN
+  PERFORM pg_notify('projects', json_build_object(
+    'op', TG_OP,
+    'slug', coalesce(new.slug, old.slug),
+    'database', coalesce(new.database, old.database),
+    'data_schema', coalesce(new.data_schema, old.data_schema)
+  )::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The legacy projects table is not created by these fixtures, so only attach the trigger if it exists
+DO $$
+BEGIN
+  IF to_regclass('public.projects') IS NOT NULL THEN
+    DROP TRIGGER IF EXISTS project_change_events ON public.projects;
+    CREATE TRIGGER project_change_events
+      AFTER INSERT OR UPDATE OR DELETE
+      ON public.projects
+      FOR EACH ROW
+    EXECUTE FUNCTION public.notify_project_change();
+  END IF;
+END;
+$$;
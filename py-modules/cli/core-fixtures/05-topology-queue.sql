@@ -0,0 +1,19 @@
+/** Durable queue of pending topology updates
+
+  Rows are keyed by project database and data schema. Workers claim a row by
+  setting `claimed_at` (selecting it with SKIP LOCKED), and delete it once the
+  update has finished, unless new edits arrived in the meantime.
+ */
+CREATE TABLE IF NOT EXISTS mapboard.topology_queue (
+  database    text        NOT NULL,
+  data_schema text        NOT NULL,
+  enqueued_at timestamptz NOT NULL DEFAULT now(),
+  updated_at  timestamptz NOT NULL DEFAULT now(),
+  attempts    integer     NOT NULL DEFAULT 0,
+  claimed_at  timestamptz,
+  claimed_by  text,
+  PRIMARY KEY (database, data_schema)
+);
+
+CREATE INDEX IF NOT EXISTS topology_queue_enqueued_at_idx
+  ON mapboard.topology_queue (enqueued_at);
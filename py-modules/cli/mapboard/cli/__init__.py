@@ -12,7 +12,7 @@ from macrostrat.dinosaur import temp_database
 from macrostrat.utils import setup_stderr_logs
 import logging
 from mapboard.core.settings import MAPBOARD_ROOT, connection_string
-from mapboard.core.workers import watch_topology, send_event
+from mapboard.core.workers import watch_topology, watch_all_topology, send_event
 
 from .database import db_app, get_srid, project_params
 from .fixtures import apply_fixtures
@@ -57,8 +57,61 @@ app.add_typer(projects_app, help="Manage Mapboard projects")
 app.add_typer(db_app, help="Database management")
 
 app.command(name="watch")(watch_topology)
+app.command(name="watch-all")(watch_all_topology)
 app.command(name="send-event")(send_event)
 
+
+@app.command(name="worker")
+def worker(lane: str = typer.Argument("interactive")):
+    """Run a task worker for a priority lane (interactive, bulk or maintenance)"""
+    from mapboard.tasks.lanes import run_worker
+
+    run_worker(lane)
+
+
+@app.command(name="submit-update")
+def submit_update(project: str):
+    """Submit a topology update for a project to the task workers"""
+    from mapboard.tasks.tasks import submit_topology_update
+
+    result = submit_topology_update(project)
+    print(f"Submitted topology update {result.id}")
+
+
+@app.command(name="progress")
+def follow_progress(task_id: str, timeout: float = 600):
+    """Follow the progress of a running task.
+
+    Gives up if the task reports no progress for --timeout seconds.
+    """
+    from mapboard.core.task_runner import get_message_queue
+    from mapboard.core.task_runner.progress import subscribe_progress
+    from rich.progress import Progress
+
+    steps = {}
+    events = subscribe_progress(get_message_queue(), task_id, timeout)
+    with Progress() as progress:
+        try:
+            for event in events:
+                if event.get("done", False):
+                    status = event["status"]
+                    if event.get("error") is not None:
+                        status += f": {event['error']}"
+                    progress.console.print(f"Task finished ({status})")
+                    break
+                step = event["step"]
+                if step not in steps:
+                    steps[step] = progress.add_task(
+                        event["description"], total=event["total"]
+                    )
+                progress.update(
+                    steps[step], completed=event["completed"], total=event["total"]
+                )
+        except TimeoutError as err:
+            progress.console.print(f"[red]{err}[/red]")
+            raise typer.Exit(1)
+
+
 from .ingest import ingest_map
 
 app.command(name="ingest")(ingest_map)
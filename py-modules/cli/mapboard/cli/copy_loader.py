@@ -0,0 +1,241 @@
+"""
+Bulk loading of GeoDataFrames into PostGIS with COPY.
+
+Frames are written in Postgres' text COPY format, with geometries as
+hex-encoded EWKB, which is much faster than the row-wise INSERTs issued by
+`GeoDataFrame.to_postgis`. Column types are mapped explicitly from pandas
+dtypes, so the target table can be created up front with the right types.
+
+Replaced tables are loaded into an unlogged staging table without indexes,
+which are built once the data is in place. The staging table is then swapped
+in with a rename, so readers never see a half-loaded or missing table.
+"""
+
+from io import StringIO
+
+import numpy as N
+import pandas as P
+import shapely
+from psycopg2.sql import SQL, Identifier
+
+_null = "\\N"
+
+# Characters that must be escaped in Postgres' text COPY format
+_escapes = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"}
+
+
+def column_types(df: P.DataFrame, srid: int = 4326) -> dict[str, str]:
+    """Map the columns of a (Geo)DataFrame to Postgres column types"""
+    types = {}
+    for name, dtype in df.dtypes.items():
+        types[name] = _postgres_type(dtype, srid)
+    return types
+
+
+def _postgres_type(dtype, srid: int) -> str:
+    if getattr(dtype, "name", None) == "geometry":
+        return f"geometry(Geometry, {srid})"
+    if P.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if P.api.types.is_integer_dtype(dtype):
+        if dtype.itemsize <= 4:
+            return "integer"
+        return "bigint"
+    if P.api.types.is_float_dtype(dtype):
+        return "double precision"
+    if isinstance(dtype, P.DatetimeTZDtype):
+        return "timestamptz"
+    if P.api.types.is_datetime64_dtype(dtype):
+        return "timestamp"
+    return "text"
+
+
+def create_table(
+    cursor,
+    schema: str,
+    table: str,
+    types: dict[str, str],
+    if_exists: str = "replace",
+    unlogged: bool = False,
+):
+    """Create a table with explicit column types.
+
+    `if_exists` follows the pandas convention: "replace" drops any existing
+    table, "append" keeps it, and "fail" raises an error.
+    """
+    if if_exists not in ("replace", "append", "fail"):
+        raise ValueError(f"Invalid value for if_exists: {if_exists}")
+
+    target = Identifier(schema, table)
+    if if_exists == "replace":
+        cursor.execute(SQL("DROP TABLE IF EXISTS {}").format(target))
+
+    columns = SQL(", ").join(
+        SQL("{} {}").format(Identifier(name), SQL(_type))
+        for name, _type in types.items()
+    )
+    statement = "CREATE {unlogged}TABLE {exists}{table} ({columns})"
+    cursor.execute(
+        SQL(statement).format(
+            unlogged=SQL("UNLOGGED " if unlogged else ""),
+            exists=SQL("IF NOT EXISTS " if if_exists == "append" else ""),
+            table=target,
+            columns=columns,
+        )
+    )
+
+
+class TableLoader:
+    """Create and finalize the tables written by a bulk load.
+
+    With `if_exists="append"`, rows are copied straight into the target tables.
+    Otherwise each table is loaded into an unlogged staging table, which
+    `finish` indexes and analyzes and `swap` renames into place. `swap` should
+    run in its own short transaction after the load is committed, so the old
+    tables stay readable for the duration of the load.
+    """
+
+    def __init__(
+        self,
+        schema: str,
+        if_exists: str = "replace",
+        indexes: dict[str, str] = None,
+    ):
+        self.schema = schema
+        self.if_exists = if_exists
+        if indexes is None:
+            indexes = {"geometry": "gist", "source_layer": "btree"}
+        self.indexes = indexes
+        self.tables: list[str] = []
+
+    @property
+    def staged(self) -> bool:
+        return self.if_exists != "append"
+
+    def load_target(self, table: str) -> str:
+        """The table that rows for `table` should be copied into"""
+        if self.staged:
+            return table + "__staging"
+        return table
+
+    def create(self, cursor, table: str, types: dict[str, str]):
+        if (
+            self.staged
+            and self.if_exists == "fail"
+            and _table_exists(cursor, self.schema, table)
+        ):
+            raise ValueError(f"Table {self.schema}.{table} already exists")
+        create_table(
+            cursor,
+            self.schema,
+            self.load_target(table),
+            types,
+            if_exists="replace" if self.staged else self.if_exists,
+            unlogged=self.staged,
+        )
+        self.tables.append(table)
+
+    def finish(self, cursor):
+        """Build indexes and planner statistics for loaded tables"""
+        for table in self.tables:
+            target = self.load_target(table)
+            ident = Identifier(self.schema, target)
+            if self.staged:
+                cursor.execute(SQL("ALTER TABLE {} SET LOGGED").format(ident))
+            for column in self._indexed_columns(cursor, target):
+                cursor.execute(
+                    SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({})").format(
+                        Identifier(f"{target}_{column}_idx"),
+                        ident,
+                        SQL(self.indexes[column]),
+                        Identifier(column),
+                    )
+                )
+            cursor.execute(SQL("ANALYZE {}").format(ident))
+
+    def swap(self, cursor):
+        """Replace the target tables with their staging tables"""
+        if not self.staged:
+            return
+        for table in self.tables:
+            staging = self.load_target(table)
+            indexed = self._indexed_columns(cursor, staging)
+            cursor.execute(
+                SQL("DROP TABLE IF EXISTS {}").format(Identifier(self.schema, table))
+            )
+            cursor.execute(
+                SQL("ALTER TABLE {} RENAME TO {}").format(
+                    Identifier(self.schema, staging), Identifier(table)
+                )
+            )
+            for column in indexed:
+                cursor.execute(
+                    SQL("ALTER INDEX {} RENAME TO {}").format(
+                        Identifier(self.schema, f"{staging}_{column}_idx"),
+                        Identifier(f"{table}_{column}_idx"),
+                    )
+                )
+
+    def _indexed_columns(self, cursor, table: str) -> list[str]:
+        cursor.execute(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s
+            """,
+            (self.schema, table),
+        )
+        columns = {row[0] for row in cursor.fetchall()}
+        return [column for column in self.indexes if column in columns]
+
+
+def _table_exists(cursor, schema: str, table: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f'"{schema}"."{table}"',))
+    return cursor.fetchone()[0]
+
+
+def copy_frame(
+    cursor,
+    df: P.DataFrame,
+    schema: str,
+    table: str,
+    srid: int = 4326,
+) -> int:
+    """Write a frame into an existing table with COPY. Returns the number of rows written."""
+    if len(df) == 0:
+        return 0
+    columns = [_serialize(column, srid) for _, column in df.items()]
+    lines = columns[0].str.cat(columns[1:], sep="\t")
+    buffer = StringIO("\n".join(lines) + "\n")
+
+    names = SQL(", ").join(Identifier(name) for name in df.columns)
+    statement = SQL("COPY {} ({}) FROM STDIN").format(Identifier(schema, table), names)
+    cursor.copy_expert(statement.as_string(cursor), buffer)
+    return len(df)
+
+
+def _serialize(column: P.Series, srid: int) -> P.Series:
+    """Convert a column to COPY text values"""
+    dtype = column.dtype
+    if getattr(dtype, "name", None) == "geometry":
+        geometries = shapely.set_srid(N.asarray(column), srid)
+        values = P.Series(
+            shapely.to_wkb(geometries, hex=True, include_srid=True),
+            index=column.index,
+            dtype=object,
+        )
+    elif P.api.types.is_bool_dtype(dtype):
+        values = column.map({True: "t", False: "f"})
+    elif P.api.types.is_numeric_dtype(dtype) or P.api.types.is_datetime64_any_dtype(
+        dtype
+    ):
+        values = column.astype(str)
+    else:
+        values = column.map(_escape, na_action="ignore")
+    return values.where(column.notna(), _null)
+
+
+def _escape(value) -> str:
+    value = str(value)
+    for char, escaped in _escapes.items():
+        value = value.replace(char, escaped)
+    return value
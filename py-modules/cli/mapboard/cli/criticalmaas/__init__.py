@@ -10,6 +10,7 @@ from psycopg2.sql import Identifier
 from pathlib import Path
 from json import dumps
 from mapboard.topology_manager.commands.update import _update
+from mapboard.core.task_runner.progress import get_progress
 
 # import logging
 # import http.client
@@ -158,17 +159,22 @@ def create(cog_id: str, system: str, system_version: str):
 
     polys = get_polygons(cog_id, system=system, system_version=system_version)
 
-    for poly in polys:
-        poly_type = poly["legend_id"]
-        geom = poly["px_geojson"]
-        map_layer = map_layer_index[poly["system"]]
-        db.run_sql(
-            """
-            INSERT INTO polygon (type, map_layer, geometry, source)
-            VALUES (:type, :map_layer, ST_Multi(ST_Scale(ST_SetSRID(ST_GeomFromGeoJSON(:geom), 3857), 1, -1)), :source)
-            """,
-            dict(type=poly_type, geom=dumps(geom), map_layer=map_layer, source=source),
-        )
+    with get_progress() as progress:
+        task = progress.add_task("Importing polygons", total=None)
+        for poly in polys:
+            poly_type = poly["legend_id"]
+            geom = poly["px_geojson"]
+            map_layer = map_layer_index[poly["system"]]
+            db.run_sql(
+                """
+                INSERT INTO polygon (type, map_layer, geometry, source)
+                VALUES (:type, :map_layer, ST_Multi(ST_Scale(ST_SetSRID(ST_GeomFromGeoJSON(:geom), 3857), 1, -1)), :source)
+                """,
+                dict(
+                    type=poly_type, geom=dumps(geom), map_layer=map_layer, source=source
+                ),
+            )
+            progress.update(task, advance=1)
 
 
 def get_legend_items(cog_id: str, **kwargs):
@@ -212,6 +218,11 @@ def list_projects():
 @app.command(name="setup-topology")
 def update_topology(project_id: str):
     db = setup_database(project_id)
+    setup_topology(db)
+
+
+def setup_topology(db: Database):
+    """Build topology layers from the polygons extracted for a CDR map"""
     assert db.engine.url.database == "criticalmaas"
     db.run_fixtures(Path(__file__).parent / "update-topology.sql")
     # Report statistics
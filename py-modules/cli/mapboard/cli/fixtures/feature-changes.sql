@@ -0,0 +1,125 @@
+/** A log of changed features, for incremental exports
+
+  Each inserted, updated or deleted line or polygon is recorded with the ID
+  of the transaction that changed it. Exports store the oldest transaction
+  that was still in progress when they started (`pg_snapshot_xmin`) as their
+  watermark, and a later delta export sends every feature changed by that
+  transaction or a newer one. Some features may be sent twice, but changes
+  committed while an export runs are never missed.
+
+  Updates that only touch columns not included in exports (e.g., topology
+  bookkeeping) are not recorded.
+
+  The log grows with every edit, so it should be pruned periodically, e.g.
+  `SELECT prune_feature_changes(now() - interval '90 days')`. Packages
+  exported before the pruned changes can no longer be updated with a
+  changeset, and must be exported again in full.
+ */
+
+CREATE TABLE IF NOT EXISTS {data_schema}.feature_changes (
+  feature_table text NOT NULL,
+  feature_id integer NOT NULL,
+  deleted boolean NOT NULL DEFAULT false,
+  xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+  changed_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS feature_changes_xid_idx
+  ON {data_schema}.feature_changes (xid);
+
+-- The newest transaction whose changes have been pruned from the log
+CREATE TABLE IF NOT EXISTS {data_schema}.feature_changes_horizon (
+  id boolean PRIMARY KEY DEFAULT true CHECK (id),
+  xid xid8 NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION {data_schema}.prune_feature_changes(_before timestamptz)
+RETURNS bigint AS
+$$
+DECLARE
+  _horizon xid8;
+  _n_pruned bigint;
+BEGIN
+  WITH pruned AS (
+    DELETE FROM {data_schema}.feature_changes
+    WHERE changed_at < _before
+    RETURNING xid
+  )
+  SELECT (SELECT xid FROM pruned ORDER BY xid DESC LIMIT 1), (SELECT count(*) FROM pruned)
+  INTO _horizon, _n_pruned;
+
+  IF _horizon IS NOT NULL THEN
+    INSERT INTO {data_schema}.feature_changes_horizon AS h (xid)
+    VALUES (_horizon)
+    ON CONFLICT (id) DO UPDATE SET xid = greatest(h.xid, EXCLUDED.xid);
+  END IF;
+  RETURN _n_pruned;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION {data_schema}.log_feature_changes()
+RETURNS trigger AS
+$$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO {data_schema}.feature_changes (feature_table, feature_id)
+    SELECT TG_TABLE_NAME, id FROM new_rows;
+  ELSIF TG_OP = 'DELETE' THEN
+    INSERT INTO {data_schema}.feature_changes (feature_table, feature_id, deleted)
+    SELECT TG_TABLE_NAME, id, true FROM old_rows;
+  ELSE
+    INSERT INTO {data_schema}.feature_changes (feature_table, feature_id)
+    SELECT TG_TABLE_NAME, n.id
+    FROM new_rows n
+    JOIN old_rows o
+      ON n.id = o.id
+    WHERE n.geometry IS DISTINCT FROM o.geometry
+       OR n.type IS DISTINCT FROM o.type
+       OR n.map_layer IS DISTINCT FROM o.map_layer
+       OR n.certainty IS DISTINCT FROM o.certainty
+       OR n.map_width IS DISTINCT FROM o.map_width
+       OR n.pixel_width IS DISTINCT FROM o.pixel_width
+       OR n.created IS DISTINCT FROM o.created;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS linework_insert_log ON {data_schema}.linework;
+CREATE TRIGGER linework_insert_log
+  AFTER INSERT ON {data_schema}.linework
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.log_feature_changes();
+
+DROP TRIGGER IF EXISTS linework_update_log ON {data_schema}.linework;
+CREATE TRIGGER linework_update_log
+  AFTER UPDATE ON {data_schema}.linework
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.log_feature_changes();
+
+DROP TRIGGER IF EXISTS linework_delete_log ON {data_schema}.linework;
+CREATE TRIGGER linework_delete_log
+  AFTER DELETE ON {data_schema}.linework
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.log_feature_changes();
+-- Keep logging deletions that skip the topology triggers (`drop-layer
+-- --skip-topology` sets session_replication_role to replica)
+ALTER TABLE {data_schema}.linework ENABLE ALWAYS TRIGGER linework_delete_log;
+
+DROP TRIGGER IF EXISTS polygon_insert_log ON {data_schema}.polygon;
+CREATE TRIGGER polygon_insert_log
+  AFTER INSERT ON {data_schema}.polygon
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.log_feature_changes();
+
+DROP TRIGGER IF EXISTS polygon_update_log ON {data_schema}.polygon;
+CREATE TRIGGER polygon_update_log
+  AFTER UPDATE ON {data_schema}.polygon
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.log_feature_changes();
+
+DROP TRIGGER IF EXISTS polygon_delete_log ON {data_schema}.polygon;
+CREATE TRIGGER polygon_delete_log
+  AFTER DELETE ON {data_schema}.polygon
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.log_feature_changes();
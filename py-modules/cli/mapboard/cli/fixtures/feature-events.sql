@@ -0,0 +1,90 @@
+/** Change notifications for the topology watcher
+
+  Each statement that modifies linework or polygons sends a single
+  notification on the `events` channel describing which features changed,
+  so the watcher can skip updates that don't affect the topology. Updates
+  that don't touch geometry, type or layer are not reported.
+ */
+
+CREATE OR REPLACE FUNCTION {data_schema}.notify_feature_changes()
+RETURNS trigger AS
+$$
+DECLARE
+  _ids integer[];
+  _attributes boolean := false;
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    SELECT array_agg(id) INTO _ids FROM new_rows;
+  ELSIF TG_OP = 'DELETE' THEN
+    SELECT array_agg(id) INTO _ids FROM old_rows;
+  ELSE
+    WITH changed AS (
+      SELECT
+        n.id,
+        (n.type IS DISTINCT FROM o.type OR n.map_layer IS DISTINCT FROM o.map_layer) attributes
+      FROM new_rows n
+      JOIN old_rows o
+        ON n.id = o.id
+      WHERE n.geometry IS DISTINCT FROM o.geometry
+         OR n.type IS DISTINCT FROM o.type
+         OR n.map_layer IS DISTINCT FROM o.map_layer
+    )
+    SELECT array_agg(id), coalesce(bool_or(attributes), false)
+    INTO _ids, _attributes
+    FROM changed;
+  END IF;
+
+  IF _ids IS NULL THEN
+    RETURN NULL;
+  END IF;
+
+  PERFORM pg_notify('events', json_build_object(
+    'type', 'feature-change',
+    'schema', TG_TABLE_SCHEMA,
+    'table', TG_TABLE_NAME,
+    'op', TG_OP,
+    -- Large statements omit their ids, to stay under the payload size limit
+    'ids', CASE WHEN cardinality(_ids) <= 500 THEN _ids END,
+    'attributes', _attributes
+  )::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS linework_insert_events ON {data_schema}.linework;
+CREATE TRIGGER linework_insert_events
+  AFTER INSERT ON {data_schema}.linework
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.notify_feature_changes();
+
+DROP TRIGGER IF EXISTS linework_update_events ON {data_schema}.linework;
+CREATE TRIGGER linework_update_events
+  AFTER UPDATE ON {data_schema}.linework
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.notify_feature_changes();
+
+DROP TRIGGER IF EXISTS linework_delete_events ON {data_schema}.linework;
+CREATE TRIGGER linework_delete_events
+  AFTER DELETE ON {data_schema}.linework
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.notify_feature_changes();
+-- Fires in replica sessions too, which `drop-layer --skip-topology` uses
+ALTER TABLE {data_schema}.linework ENABLE ALWAYS TRIGGER linework_delete_events;
+
+DROP TRIGGER IF EXISTS polygon_insert_events ON {data_schema}.polygon;
+CREATE TRIGGER polygon_insert_events
+  AFTER INSERT ON {data_schema}.polygon
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.notify_feature_changes();
+
+DROP TRIGGER IF EXISTS polygon_update_events ON {data_schema}.polygon;
+CREATE TRIGGER polygon_update_events
+  AFTER UPDATE ON {data_schema}.polygon
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.notify_feature_changes();
+
+DROP TRIGGER IF EXISTS polygon_delete_events ON {data_schema}.polygon;
+CREATE TRIGGER polygon_delete_events
+  AFTER DELETE ON {data_schema}.polygon
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.notify_feature_changes();
@@ -0,0 +1,388 @@
+/** Per-layer feature statistics
+
+  Counts, total length and area, and the extent of the features of each
+  map layer and type are kept up to date by statement-level triggers, so
+  that commands needing a layer's extent or size don't have to scan it.
+
+  Triggers only append the changes of each statement to `layer_stats_delta`,
+  so that concurrent edits never wait on each other's statistics rows.
+  Deltas are merged into `layer_stats` by `merge_layer_stats`, which the
+  triggers call too, but which is skipped while another transaction is
+  merging. `layer_stats_current` adds deltas that are not merged yet, and
+  is what readers should use.
+
+  Counts and sizes are maintained exactly. Extents grow as features are
+  added, but deleting a feature on the edge of a layer can't shrink them
+  without a scan, so the row is only flagged as stale. `layer_stats_extent`
+  recomputes stale extents when they are read. Once the last feature of a
+  layer and type is removed, its extent is cleared instead.
+
+  Updates are only counted for rows whose geometry, type or layer changed,
+  so that e.g. topology bookkeeping doesn't recompute lengths and areas.
+ */
+
+CREATE TABLE IF NOT EXISTS {data_schema}.layer_stats (
+  feature_table text NOT NULL,
+  map_layer integer NOT NULL,
+  type text NOT NULL,
+  n_features bigint NOT NULL DEFAULT 0,
+  total_length double precision NOT NULL DEFAULT 0,
+  total_area double precision NOT NULL DEFAULT 0,
+  xmin double precision,
+  ymin double precision,
+  xmax double precision,
+  ymax double precision,
+  extent_stale boolean NOT NULL DEFAULT false,
+  PRIMARY KEY (feature_table, map_layer, type)
+);
+
+CREATE TABLE IF NOT EXISTS {data_schema}.layer_stats_delta (
+  feature_table text NOT NULL,
+  map_layer integer NOT NULL,
+  type text NOT NULL,
+  n_features bigint NOT NULL,
+  total_length double precision NOT NULL,
+  total_area double precision NOT NULL,
+  -- The extent of the features that were added or removed
+  xmin double precision,
+  ymin double precision,
+  xmax double precision,
+  ymax double precision,
+  removed boolean NOT NULL
+);
+
+CREATE OR REPLACE VIEW {data_schema}.layer_stats_current AS
+SELECT
+  feature_table,
+  map_layer,
+  type,
+  sum(n_features)::bigint n_features,
+  sum(total_length) total_length,
+  sum(total_area) total_area,
+  min(xmin) xmin,
+  min(ymin) ymin,
+  max(xmax) xmax,
+  max(ymax) ymax,
+  bool_or(extent_stale) extent_stale
+FROM (
+  SELECT
+    feature_table, map_layer, type, n_features, total_length, total_area,
+    xmin, ymin, xmax, ymax, extent_stale
+  FROM {data_schema}.layer_stats
+  UNION ALL
+  -- Until they are merged, removals mark the extent as stale
+  SELECT
+    feature_table, map_layer, type, n_features, total_length, total_area,
+    CASE WHEN NOT removed THEN xmin END,
+    CASE WHEN NOT removed THEN ymin END,
+    CASE WHEN NOT removed THEN xmax END,
+    CASE WHEN NOT removed THEN ymax END,
+    removed
+  FROM {data_schema}.layer_stats_delta
+) s
+GROUP BY feature_table, map_layer, type;
+
+CREATE OR REPLACE FUNCTION {data_schema}.merge_layer_stats(_wait boolean DEFAULT false)
+RETURNS boolean AS
+$$
+BEGIN
+  -- Only one transaction merges at a time. Unless `_wait` is set, others
+  -- return false right away, and their deltas are merged later.
+  IF _wait THEN
+    PERFORM pg_advisory_xact_lock(hashtext('{data_schema}.layer_stats'));
+  ELSIF NOT pg_try_advisory_xact_lock(hashtext('{data_schema}.layer_stats')) THEN
+    RETURN false;
+  END IF;
+
+  WITH deltas AS (
+    DELETE FROM {data_schema}.layer_stats_delta
+    RETURNING *
+  ),
+  changes AS (
+    SELECT
+      feature_table,
+      map_layer,
+      type,
+      sum(n_features) n_features,
+      sum(total_length) total_length,
+      sum(total_area) total_area,
+      min(xmin) FILTER (WHERE NOT removed) xmin,
+      min(ymin) FILTER (WHERE NOT removed) ymin,
+      max(xmax) FILTER (WHERE NOT removed) xmax,
+      max(ymax) FILTER (WHERE NOT removed) ymax,
+      min(xmin) FILTER (WHERE removed) removed_xmin,
+      min(ymin) FILTER (WHERE removed) removed_ymin,
+      max(xmax) FILTER (WHERE removed) removed_xmax,
+      max(ymax) FILTER (WHERE removed) removed_ymax
+    FROM deltas
+    GROUP BY feature_table, map_layer, type
+  ),
+  merged AS (
+    SELECT
+      c.feature_table,
+      c.map_layer,
+      c.type,
+      coalesce(s.n_features, 0) + c.n_features n_features,
+      coalesce(s.total_length, 0) + c.total_length total_length,
+      coalesce(s.total_area, 0) + c.total_area total_area,
+      least(s.xmin, c.xmin) xmin,
+      least(s.ymin, c.ymin) ymin,
+      greatest(s.xmax, c.xmax) xmax,
+      greatest(s.ymax, c.ymax) ymax,
+      coalesce(s.extent_stale, false) extent_stale,
+      c.removed_xmin,
+      c.removed_ymin,
+      c.removed_xmax,
+      c.removed_ymax
+    FROM changes c
+    LEFT JOIN {data_schema}.layer_stats s
+      USING (feature_table, map_layer, type)
+  )
+  INSERT INTO {data_schema}.layer_stats AS s
+  SELECT
+    feature_table,
+    map_layer,
+    type,
+    n_features,
+    total_length,
+    total_area,
+    -- An empty layer has no extent
+    CASE WHEN n_features > 0 THEN xmin END,
+    CASE WHEN n_features > 0 THEN ymin END,
+    CASE WHEN n_features > 0 THEN xmax END,
+    CASE WHEN n_features > 0 THEN ymax END,
+    -- Removing features from the edge of the layer may shrink its extent
+    n_features > 0 AND (
+      extent_stale OR coalesce(
+        removed_xmin <= xmin
+        OR removed_ymin <= ymin
+        OR removed_xmax >= xmax
+        OR removed_ymax >= ymax,
+        false
+      )
+    )
+  FROM merged
+  -- Rows are locked in a fixed order
+  ORDER BY feature_table, map_layer, type
+  ON CONFLICT (feature_table, map_layer, type) DO UPDATE SET
+    n_features = EXCLUDED.n_features,
+    total_length = EXCLUDED.total_length,
+    total_area = EXCLUDED.total_area,
+    xmin = EXCLUDED.xmin,
+    ymin = EXCLUDED.ymin,
+    xmax = EXCLUDED.xmax,
+    ymax = EXCLUDED.ymax,
+    extent_stale = EXCLUDED.extent_stale;
+  RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION {data_schema}.refresh_layer_stats()
+RETURNS void AS
+$$
+BEGIN
+  -- Deltas of transactions that commit later are not in this snapshot, so
+  -- they are kept and merged afterwards
+  PERFORM pg_advisory_xact_lock(hashtext('{data_schema}.layer_stats'));
+  DELETE FROM {data_schema}.layer_stats_delta;
+  DELETE FROM {data_schema}.layer_stats;
+  INSERT INTO {data_schema}.layer_stats
+  SELECT
+    feature_table,
+    map_layer,
+    type,
+    count(*),
+    coalesce(sum(ST_Length(geometry)), 0),
+    coalesce(sum(ST_Area(geometry)), 0),
+    ST_XMin(ST_Extent(geometry)),
+    ST_YMin(ST_Extent(geometry)),
+    ST_XMax(ST_Extent(geometry)),
+    ST_YMax(ST_Extent(geometry)),
+    false
+  FROM (
+    SELECT 'linework' feature_table, map_layer, type, geometry FROM {data_schema}.linework
+    UNION ALL
+    SELECT 'polygon', map_layer, type, geometry FROM {data_schema}.polygon
+  ) features
+  WHERE map_layer IS NOT NULL
+    AND type IS NOT NULL
+  GROUP BY feature_table, map_layer, type;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION {data_schema}.layer_stats_extent(_feature_table text, _map_layer integer)
+RETURNS TABLE (xmin double precision, ymin double precision, xmax double precision, ymax double precision) AS
+$$
+DECLARE
+  _merged boolean := {data_schema}.merge_layer_stats();
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM {data_schema}.layer_stats_current s
+    WHERE s.feature_table = _feature_table
+      AND s.map_layer = _map_layer
+      AND s.n_features > 0
+      AND s.extent_stale
+  ) THEN
+    IF NOT _merged THEN
+      -- Another transaction is merging, so scan without storing the result
+      RETURN QUERY
+      SELECT ST_XMin(e.extent), ST_YMin(e.extent), ST_XMax(e.extent), ST_YMax(e.extent)
+      FROM (
+        SELECT ST_Extent(f.geometry) extent
+        FROM (
+          SELECT l.geometry
+          FROM {data_schema}.linework l
+          WHERE _feature_table = 'linework'
+            AND l.map_layer = _map_layer
+            AND l.type IS NOT NULL
+          UNION ALL
+          SELECT p.geometry
+          FROM {data_schema}.polygon p
+          WHERE _feature_table = 'polygon'
+            AND p.map_layer = _map_layer
+            AND p.type IS NOT NULL
+        ) f
+      ) e;
+      RETURN;
+    END IF;
+
+    UPDATE {data_schema}.layer_stats s
+    SET xmin = ST_XMin(e.extent), ymin = ST_YMin(e.extent),
+        xmax = ST_XMax(e.extent), ymax = ST_YMax(e.extent),
+        extent_stale = false
+    FROM (
+      SELECT 'linework' feature_table, l.type, ST_Extent(l.geometry) extent
+      FROM {data_schema}.linework l
+      WHERE _feature_table = 'linework'
+        AND l.map_layer = _map_layer
+      GROUP BY l.type
+      UNION ALL
+      SELECT 'polygon', p.type, ST_Extent(p.geometry)
+      FROM {data_schema}.polygon p
+      WHERE _feature_table = 'polygon'
+        AND p.map_layer = _map_layer
+      GROUP BY p.type
+    ) e
+    WHERE s.feature_table = e.feature_table
+      AND s.map_layer = _map_layer
+      AND s.type = e.type
+      AND s.extent_stale;
+  END IF;
+
+  RETURN QUERY
+  SELECT min(s.xmin), min(s.ymin), max(s.xmax), max(s.ymax)
+  FROM {data_schema}.layer_stats_current s
+  WHERE s.feature_table = _feature_table
+    AND s.map_layer = _map_layer
+    AND s.n_features > 0;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION {data_schema}.update_layer_stats()
+RETURNS trigger AS
+$$
+DECLARE
+  _changed integer[];
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    SELECT array_agg(n.id)
+    INTO _changed
+    FROM new_rows n
+    JOIN old_rows o
+      ON n.id = o.id
+    WHERE n.geometry IS DISTINCT FROM o.geometry
+       OR n.type IS DISTINCT FROM o.type
+       OR n.map_layer IS DISTINCT FROM o.map_layer;
+    IF _changed IS NULL THEN
+      RETURN NULL;
+    END IF;
+  END IF;
+
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO {data_schema}.layer_stats_delta
+    SELECT
+      TG_TABLE_NAME,
+      map_layer,
+      type,
+      -count(*),
+      -coalesce(sum(ST_Length(geometry)), 0),
+      -coalesce(sum(ST_Area(geometry)), 0),
+      ST_XMin(ST_Extent(geometry)),
+      ST_YMin(ST_Extent(geometry)),
+      ST_XMax(ST_Extent(geometry)),
+      ST_YMax(ST_Extent(geometry)),
+      true
+    FROM old_rows
+    WHERE map_layer IS NOT NULL
+      AND type IS NOT NULL
+      AND (TG_OP = 'DELETE' OR id = ANY(_changed))
+    GROUP BY map_layer, type;
+  END IF;
+
+  IF TG_OP IN ('UPDATE', 'INSERT') THEN
+    INSERT INTO {data_schema}.layer_stats_delta
+    SELECT
+      TG_TABLE_NAME,
+      map_layer,
+      type,
+      count(*),
+      coalesce(sum(ST_Length(geometry)), 0),
+      coalesce(sum(ST_Area(geometry)), 0),
+      ST_XMin(ST_Extent(geometry)),
+      ST_YMin(ST_Extent(geometry)),
+      ST_XMax(ST_Extent(geometry)),
+      ST_YMax(ST_Extent(geometry)),
+      false
+    FROM new_rows
+    WHERE map_layer IS NOT NULL
+      AND type IS NOT NULL
+      AND (TG_OP = 'INSERT' OR id = ANY(_changed))
+    GROUP BY map_layer, type;
+  END IF;
+
+  PERFORM {data_schema}.merge_layer_stats();
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS linework_insert_stats ON {data_schema}.linework;
+CREATE TRIGGER linework_insert_stats
+  AFTER INSERT ON {data_schema}.linework
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.update_layer_stats();
+
+DROP TRIGGER IF EXISTS linework_update_stats ON {data_schema}.linework;
+CREATE TRIGGER linework_update_stats
+  AFTER UPDATE ON {data_schema}.linework
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.update_layer_stats();
+
+DROP TRIGGER IF EXISTS linework_delete_stats ON {data_schema}.linework;
+CREATE TRIGGER linework_delete_stats
+  AFTER DELETE ON {data_schema}.linework
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.update_layer_stats();
+-- Deletions are still counted when `drop-layer --skip-topology` sets
+-- session_replication_role to skip the topology triggers
+ALTER TABLE {data_schema}.linework ENABLE ALWAYS TRIGGER linework_delete_stats;
+
+DROP TRIGGER IF EXISTS polygon_insert_stats ON {data_schema}.polygon;
+CREATE TRIGGER polygon_insert_stats
+  AFTER INSERT ON {data_schema}.polygon
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.update_layer_stats();
+
+DROP TRIGGER IF EXISTS polygon_update_stats ON {data_schema}.polygon;
+CREATE TRIGGER polygon_update_stats
+  AFTER UPDATE ON {data_schema}.polygon
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.update_layer_stats();
+
+DROP TRIGGER IF EXISTS polygon_delete_stats ON {data_schema}.polygon;
+CREATE TRIGGER polygon_delete_stats
+  AFTER DELETE ON {data_schema}.polygon
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION {data_schema}.update_layer_stats();
+
+-- Statistics are rebuilt whenever fixtures are applied, to pick up existing features
+SELECT {data_schema}.refresh_layer_stats();
@@ -1,13 +1,15 @@
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import List
+from typing import Iterable, List
 
+import fiona
 import geopandas as G
 import IPython
 import pandas as P
-from geoalchemy2 import Geometry
+from mapboard.core.task_runner.progress import get_progress
 from rich.console import Console
-from rich.progress import Progress
 from shapely.geometry import (
     LineString,
     MultiLineString,
@@ -16,8 +18,8 @@ from shapely.geometry import (
     Point,
     Polygon,
 )
-from sqlalchemy import *
 
+from .copy_loader import TableLoader, column_types, copy_frame
 from .database import setup_database
 
 console = Console()
@@ -29,19 +31,44 @@ def ingest_map(
     embed: bool = False,
     crs: str = None,
     if_exists: str = "replace",
-    chunksize: int = 100,
+    chunksize: int = 10000,
+    stream: bool = False,
+    jobs: int = 1,
+    incremental: bool = False,
 ):
-    """Ingest shapefiles into the database."""
+    """Ingest shapefiles into the database.
+
+    With `--jobs`, files (or with `--stream`, batches of features) are read
+    and reprojected in a pool of worker processes. Reading only overlaps with
+    writing to the database with `--stream`: otherwise every file is read
+    before any features are written. With `--incremental`, only the changes
+    since the last ingest are applied.
+    """
     console.print("[bold]Ingesting map data for source [bold blue]" + slug)
+    if incremental:
+        from .ingest_incremental import ingest_map_incremental
+
+        return ingest_map_incremental(
+            slug, files, crs=crs, batch_size=chunksize, jobs=jobs
+        )
+    if stream:
+        return ingest_map_streaming(
+            slug,
+            files,
+            crs=crs,
+            if_exists=if_exists,
+            batch_size=chunksize,
+            jobs=jobs,
+        )
     # Read file with GeoPandas and dump to PostGIS
 
     # We need to put multigeometries first, otherwise they might not be used in the
     frames = defaultdict(list)
     db = setup_database("mapboard")
 
-    for file in files:
-        df = G.read_file(file)
-
+    # Files are read and reprojected in parallel, but handled in their original order
+    results = ordered_map(_read_file, [(file, crs) for file in files], jobs)
+    for file, df in zip(files, results):
         console.print(file, style="bold cyan")
 
         # Print geometry type statistics
@@ -50,25 +77,7 @@ def ingest_map(
             console.print(f"- {count} {geom_type}s")
 
         if crs is not None:
-            if df.crs is None:
-                console.print("Forcing input CRS to [bold yellow]" + crs)
-                df.crs = crs
-            else:
-                raise ValueError("CRS already set")
-
-        # If no CRS is set, demand one.
-        if df.crs is None:
-            console.print(
-                "No CRS set. Please set a CRS before ingesting.", style="bold red"
-            )
-            raise Exception("No CRS set")
-
-        # Convert geometry to WGS84
-        console.print("Projecting to WGS84")
-        df = df.to_crs("EPSG:4326")
-
-        # Add file name to dataframe
-        df["source_layer"] = file.stem
+            console.print("Forced input CRS to [bold yellow]" + crs)
 
         # Concatenate to polygons
         for feature_type in ("Polygon", "LineString", "Point"):
@@ -80,63 +89,273 @@ def ingest_map(
     if embed:
         IPython.embed()
 
-    for feature_type, df_list in frames.items():
-        # Concatenate all dataframes
-        df = G.GeoDataFrame(P.concat(df_list, ignore_index=True)).dropna(
-            axis=1, how="all"
+    schema = f"{slug}_data"
+    db.run_sql(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+    loader = TableLoader(schema, if_exists=if_exists)
+
+    with db.engine.begin() as conn, get_progress() as progress:
+        cursor = conn.connection.cursor()
+        for feature_type, df_list in frames.items():
+            # Concatenate all dataframes
+            df = G.GeoDataFrame(P.concat(df_list, ignore_index=True)).dropna(
+                axis=1, how="all"
+            )
+            # Don't replace an existing table with an empty one
+            if len(df) == 0:
+                continue
+
+            console.print(
+                f"[bold]{feature_type}s[/bold] [dim]- {len(df)} features[/dim]"
+            )
+            # Columns
+            console.print("Columns:")
+            for col in df.columns:
+                console.print(f"- {col}")
+
+            table = table_name(slug, feature_type)
+            console.print(f"Writing [blue dim]{schema}.{table}")
+
+            # Declaring the geometry type up front ensures that multigeometries fit
+            loader.create(cursor, table, column_types(df))
+
+            # Stream chunks into PostGIS with COPY
+            task = progress.add_task(f"Writing {feature_type}s", total=len(df))
+            for chunk in chunker(df, chunksize):
+                copy_frame(cursor, chunk, schema, loader.load_target(table))
+                progress.update(task, advance=len(chunk))
+
+        console.print("Building indexes")
+        loader.finish(cursor)
+
+    # Swap in the new tables only once they are completely loaded
+    with db.engine.begin() as conn:
+        loader.swap(conn.connection.cursor())
+
+
+def ingest_map_streaming(
+    slug: str,
+    files: List[Path],
+    crs: str = None,
+    if_exists: str = "replace",
+    batch_size: int = 10000,
+    jobs: int = 1,
+):
+    """Ingest vector files in batches, without holding whole files in memory.
+
+    A first pass reads only the file metadata, to unify the columns of all files.
+    Each batch of features is then reprojected, split by geometry type and
+    copied into the database before the next batch is read.
+    """
+    db = setup_database("mapboard")
+    schema = f"{slug}_data"
+
+    layers = [_read_layer_info(file, crs) for file in files]
+    types = _unified_column_types(layers)
+    types["source_layer"] = "text"
+    types["geometry"] = "geometry(Geometry, 4326)"
+
+    console.print("Columns:")
+    for col, _type in types.items():
+        console.print(f"- {col} [dim]{_type}[/dim]")
+
+    db.run_sql(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+
+    loader = TableLoader(schema, if_exists=if_exists)
+    with db.engine.begin() as conn, get_progress() as progress:
+        cursor = conn.connection.cursor()
+        task = progress.add_task(
+            "Writing features", total=sum(layer["count"] for layer in layers)
+        )
+        batches = (
+            batch
+            for layer in layers
+            for batch in feature_batches(layer["file"], layer["crs"], batch_size)
         )
+        counts = defaultdict(Counter)
+        for file, df in ordered_map(_read_batch, batches, jobs):
+            counts[file].update(df.geometry.type.value_counts().to_dict())
+            df["source_layer"] = file.stem
+            df = _conform(df, types)
+
+            for feature_type in ("Polygon", "LineString", "Point"):
+                mask = df.geometry.type.isin([feature_type, "Multi" + feature_type])
+                if not mask.any():
+                    continue
+                table = table_name(slug, feature_type)
+                if table not in loader.tables:
+                    loader.create(cursor, table, types)
+                copy_frame(cursor, df[mask], schema, loader.load_target(table))
+            progress.update(task, advance=len(df))
+
+        for layer in layers:
+            console.print(layer["file"], style="bold cyan")
+            for geom_type, count in sorted(counts[layer["file"]].items()):
+                console.print(f"- {count} {geom_type}s")
 
-        console.print(f"[bold]{feature_type}s[/bold] [dim]- {len(df)} features[/dim]")
-        # Columns
-        console.print("Columns:")
-        for col in df.columns:
-            console.print(f"- {col}")
+        if loader.staged:
+            for table in loader.tables:
+                _drop_empty_columns(cursor, schema, loader.load_target(table), types)
+        console.print("Building indexes")
+        loader.finish(cursor)
 
-        feature_suffix = feature_type.lower() + "s"
-        if feature_suffix == "linestrings":
-            feature_suffix = "lines"
+    with db.engine.begin() as conn:
+        loader.swap(conn.connection.cursor())
+    for table in loader.tables:
+        console.print(f"Wrote [blue dim]{schema}.{table}")
 
-        table = f"{slug}_{feature_suffix}"
-        schema = f"{slug}_data"
 
-        db.run_sql(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+def table_name(slug: str, feature_type: str) -> str:
+    feature_suffix = feature_type.lower() + "s"
+    if feature_suffix == "linestrings":
+        feature_suffix = "lines"
+    return f"{slug}_{feature_suffix}"
 
-        console.print(f"Writing [blue dim]{schema}.{table}")
-        # Get first 10 rows
 
-        # Iterate through chunks and write to PostGIS
-        with Progress() as progress:
-            task = progress.add_task(
-                f"Writing {feature_type}s",
-                total=len(df),
+# Postgres types for the field types reported by OGR
+_field_types = {
+    "str": "text",
+    "int": "bigint",
+    "int32": "integer",
+    "int64": "bigint",
+    "float": "double precision",
+    "bool": "boolean",
+    "date": "date",
+    "time": "time",
+    "datetime": "timestamp",
+}
+
+
+def _read_layer_info(file: Path, crs: str = None) -> dict:
+    with fiona.open(file) as src:
+        file_crs = src.crs or None
+        if crs is not None:
+            if file_crs is not None:
+                raise ValueError("CRS already set")
+            console.print(f"Forcing input CRS of {file.name} to [bold yellow]" + crs)
+            file_crs = crs
+        if file_crs is None:
+            console.print(
+                f"No CRS set for {file.name}. Please set a CRS before ingesting.",
+                style="bold red",
             )
+            raise Exception("No CRS set")
+
+        fields = {
+            name: _field_types.get(_type.split(":")[0], "text")
+            for name, _type in src.schema["properties"].items()
+        }
+        return dict(file=file, crs=file_crs, fields=fields, count=len(src))
+
+
+def _unified_column_types(layers: list[dict]) -> dict[str, str]:
+    """Combine the fields of several layers, widening conflicting types to text"""
+    types = {}
+    for layer in layers:
+        for name, _type in layer["fields"].items():
+            if types.get(name, _type) != _type:
+                _type = "text"
+            types[name] = _type
+    return types
+
+
+def _read_file(file: Path, crs: str = None) -> G.GeoDataFrame:
+    """Read a file and project it to WGS84"""
+    df = G.read_file(file)
+
+    if crs is not None:
+        if df.crs is None:
+            df.crs = crs
+        else:
+            raise ValueError("CRS already set")
+
+    # If no CRS is set, demand one.
+    if df.crs is None:
+        raise Exception(f"No CRS set for {file}. Please set a CRS before ingesting.")
+
+    df = df.to_crs("EPSG:4326")
+    # Add file name to dataframe
+    df["source_layer"] = file.stem
+    return df
+
+
+def feature_batches(file: Path, crs, batch_size: int, skip: int = 0):
+    """Read a file in batches of features, in a single pass.
+
+    Yields arguments for `_read_batch`. Reading each batch with a fresh
+    `items(start, stop)` call would re-scan the file from the start for
+    drivers that can't seek (e.g. GeoJSON).
+    """
+    with fiona.open(file) as src:
+        columns = list(src.schema["properties"].keys()) + ["geometry"]
+        features = islice(src, skip, None)
+        while batch := list(islice(features, batch_size)):
+            # Plain dicts can be sent to worker processes
+            batch = [getattr(f, "__geo_interface__", f) for f in batch]
+            yield (file, crs, columns, batch)
+
+
+def _read_batch(file: Path, crs, columns: list[str], features: list[dict]):
+    """Build a frame from a batch of features and project it to WGS84"""
+    df = G.GeoDataFrame.from_features(features, crs=crs, columns=columns)
+    return file, df.to_crs("EPSG:4326")
+
+
+def ordered_map(func, args: Iterable[tuple], jobs: int = 1):
+    """Apply a function to each set of arguments, yielding results in order.
+
+    With more than one job, calls run in a process pool. Only a few results are
+    computed ahead of the consumer, so a slow consumer holds back the workers
+    instead of letting finished results pile up in memory.
+    """
+    if jobs <= 1:
+        for _args in args:
+            yield func(*_args)
+        return
+
+    pending = deque()
+    remaining = iter(args)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for _args in islice(remaining, 2 * jobs):
+            pending.append(executor.submit(func, *_args))
+        while len(pending) > 0:
+            result = pending.popleft().result()
+            for _args in islice(remaining, 1):
+                pending.append(executor.submit(func, *_args))
+            yield result
+
+
+# Nullable pandas dtypes that serialize cleanly for COPY
+_pandas_types = {
+    "bigint": "Int64",
+    "integer": "Int32",
+    "double precision": "float64",
+    "boolean": "boolean",
+}
+
+
+def _conform(df: G.GeoDataFrame, types: dict[str, str]) -> G.GeoDataFrame:
+    """Give a batch the columns and types of the unified schema"""
+    for name, _type in types.items():
+        if name not in df.columns:
+            df[name] = None
+        dtype = _pandas_types.get(_type, None)
+        if dtype is not None:
+            df[name] = df[name].astype(dtype)
+    return df[list(types.keys())]
 
-            conn = db.engine.connect()
-
-            for i, chunk in enumerate(chunker(df, chunksize)):
-                chunk.to_postgis(
-                    table,
-                    conn,
-                    schema=schema,
-                    if_exists=if_exists if i == 0 else "append",
-                    dtype={
-                        "geometry": Geometry(
-                            geometry_type="Geometry",
-                            spatial_index=True,
-                            srid=4326,
-                        ),
-                    },
-                )
-                # Ensure multigeometries are used (brute force)
-                if i == 0:
-                    conn.execute(
-                        text(
-                            f"ALTER TABLE {schema}.{table} ALTER COLUMN geometry TYPE Geometry(Geometry, 4326)"
-                        )
-                    )
-                progress.update(task, advance=len(chunk))
 
-            conn.commit()
+def _drop_empty_columns(cursor, schema: str, table: str, types: dict[str, str]):
+    """Drop attribute columns that are empty for this geometry type"""
+    columns = [name for name in types if name not in ("geometry", "source_layer")]
+    if len(columns) == 0:
+        return
+    counts = ", ".join(f'count("{name}")' for name in columns)
+    cursor.execute(f'SELECT {counts} FROM {schema}."{table}"')
+    empty = [name for name, count in zip(columns, cursor.fetchone()) if count == 0]
+    if len(empty) == 0:
+        return
+    drops = ", ".join(f'DROP COLUMN "{name}"' for name in empty)
+    cursor.execute(f'ALTER TABLE {schema}."{table}" {drops}')
 
 
 def chunker(seq, size):
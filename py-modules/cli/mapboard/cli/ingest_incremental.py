@@ -0,0 +1,380 @@
+"""
+Incremental re-ingest of updated map deliveries.
+
+Each ingested file is recorded with a hash of its contents, so unchanged files
+are skipped outright. Features of changed files are matched on a hash of their
+geometry and attributes: only new features are inserted, and features missing
+from the new delivery are deleted, including those of whole files that are no
+longer delivered. Progress is committed after each batch, so an interrupted
+ingest resumes where it left off.
+"""
+
+from collections import Counter
+from hashlib import sha256
+from pathlib import Path
+from typing import List
+
+from mapboard.core.task_runner.progress import get_progress
+from psycopg2.sql import SQL, Identifier, Literal
+
+from .copy_loader import copy_frame
+from .database import setup_database
+from .ingest import (
+    _conform,
+    _read_batch,
+    _read_layer_info,
+    _unified_column_types,
+    console,
+    feature_batches,
+    ordered_map,
+    table_name,
+)
+
+# Files that make up a shapefile, besides the .shp itself
+_sidecars = (".dbf", ".shx", ".prj", ".cpg")
+
+
+def ingest_map_incremental(
+    slug: str,
+    files: List[Path],
+    crs: str = None,
+    batch_size: int = 10000,
+    jobs: int = 1,
+):
+    """Update previously ingested tables with the changes in a new delivery"""
+    db = setup_database("mapboard")
+    schema = f"{slug}_data"
+    db.run_sql(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+
+    layers = [_read_layer_info(file, crs) for file in files]
+    types = _unified_column_types(layers)
+    types["source_layer"] = "text"
+    types["geometry"] = "geometry(Geometry, 4326)"
+    types["feature_hash"] = "text"
+
+    with db.engine.connect() as conn, get_progress() as progress:
+        # Commits go straight to the driver connection, so each batch is durable
+        conn = conn.connection
+        cursor = conn.cursor()
+        _create_state_tables(cursor, schema)
+        conn.commit()
+
+        for layer in layers:
+            file = layer["file"]
+            source_layer = file.stem
+            content_hash = file_hash(file)
+
+            state = _get_state(cursor, schema, source_layer)
+            start = 0
+            if state is not None and state["content_hash"] == content_hash:
+                if state["completed"]:
+                    console.print(f"{file} [dim]unchanged, skipping[/dim]")
+                    continue
+                if state["batch_size"] == batch_size:
+                    start = state["batches_done"]
+                    console.print(f"{file} [dim]resuming after batch {start}[/dim]")
+
+            if start == 0:
+                _start_file(
+                    cursor, schema, source_layer, file, content_hash, batch_size
+                )
+                conn.commit()
+
+            console.print(file, style="bold cyan")
+            batches = feature_batches(
+                file, layer["crs"], batch_size, skip=start * batch_size
+            )
+            task = progress.add_task(
+                f"Updating {source_layer}",
+                total=layer["count"],
+                completed=start * batch_size,
+            )
+            tables = set()
+            results = ordered_map(_read_batch, batches, jobs)
+            for n, (_, df) in enumerate(results, start=start + 1):
+                df["source_layer"] = source_layer
+                df = _conform(df, types)
+                for feature_type in ("Polygon", "LineString", "Point"):
+                    mask = df.geometry.type.isin([feature_type, "Multi" + feature_type])
+                    if not mask.any():
+                        continue
+                    table = table_name(slug, feature_type)
+                    _ensure_table(cursor, schema, table, types)
+                    tables.add(table)
+                    inserted = _merge_batch(cursor, schema, table, df[mask])
+                    if inserted > 0:
+                        console.print(f"- {inserted} new {feature_type}s")
+                _set_progress(cursor, schema, source_layer, n)
+                conn.commit()
+                progress.update(task, advance=len(df))
+
+            # Tables written by an earlier, interrupted run may hold this layer too
+            tables |= _existing_tables(cursor, schema, slug)
+            for table in sorted(tables):
+                deleted = _delete_vanished(cursor, schema, table, source_layer)
+                if deleted > 0:
+                    console.print(f"- {deleted} features removed from {table}")
+            _finish_file(cursor, schema, source_layer)
+            conn.commit()
+
+        # As with a full re-ingest, layers missing from the delivery are dropped
+        delivered = [layer["file"].stem for layer in layers]
+        if len(delivered) == 0:
+            return
+        removed = Counter()
+        for table in _existing_tables(cursor, schema, slug):
+            removed.update(_delete_missing_layers(cursor, schema, table, delivered))
+        _forget_missing_layers(cursor, schema, delivered)
+        conn.commit()
+        for source_layer, count in sorted(removed.items()):
+            console.print(
+                f"{source_layer} [dim]no longer delivered, removed {count} features[/dim]"
+            )
+
+
+def file_hash(file: Path) -> str:
+    """Hash the contents of a file, including shapefile sidecar files"""
+    digest = sha256()
+    paths = [file] + [file.with_suffix(suffix) for suffix in _sidecars]
+    for path in paths:
+        if not path.exists():
+            continue
+        with path.open("rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _create_state_tables(cursor, schema: str):
+    cursor.execute(
+        SQL(
+            """
+            CREATE TABLE IF NOT EXISTS {files} (
+              source_layer text PRIMARY KEY,
+              file text NOT NULL,
+              content_hash text NOT NULL,
+              batch_size integer NOT NULL,
+              batches_done integer NOT NULL DEFAULT 0,
+              completed boolean NOT NULL DEFAULT false,
+              updated_at timestamptz NOT NULL DEFAULT now()
+            );
+            CREATE TABLE IF NOT EXISTS {seen} (
+              source_layer text NOT NULL,
+              feature_hash text NOT NULL,
+              PRIMARY KEY (source_layer, feature_hash)
+            );
+            """
+        ).format(
+            files=Identifier(schema, "ingest_files"),
+            seen=Identifier(schema, "ingest_seen"),
+        )
+    )
+
+
+def _get_state(cursor, schema: str, source_layer: str):
+    cursor.execute(
+        SQL(
+            "SELECT content_hash, batch_size, batches_done, completed FROM {} WHERE source_layer = %s"
+        ).format(Identifier(schema, "ingest_files")),
+        (source_layer,),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip(("content_hash", "batch_size", "batches_done", "completed"), row))
+
+
+def _start_file(
+    cursor,
+    schema: str,
+    source_layer: str,
+    file: Path,
+    content_hash: str,
+    batch_size: int,
+):
+    cursor.execute(
+        SQL(
+            """
+            INSERT INTO {files} (source_layer, file, content_hash, batch_size)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (source_layer) DO UPDATE SET
+              file = EXCLUDED.file,
+              content_hash = EXCLUDED.content_hash,
+              batch_size = EXCLUDED.batch_size,
+              batches_done = 0,
+              completed = false,
+              updated_at = now()
+            """
+        ).format(files=Identifier(schema, "ingest_files")),
+        (source_layer, str(file), content_hash, batch_size),
+    )
+    cursor.execute(
+        SQL("DELETE FROM {} WHERE source_layer = %s").format(
+            Identifier(schema, "ingest_seen")
+        ),
+        (source_layer,),
+    )
+
+
+def _set_progress(cursor, schema: str, source_layer: str, batches_done: int):
+    cursor.execute(
+        SQL(
+            "UPDATE {} SET batches_done = %s, updated_at = now() WHERE source_layer = %s"
+        ).format(Identifier(schema, "ingest_files")),
+        (batches_done, source_layer),
+    )
+
+
+def _finish_file(cursor, schema: str, source_layer: str):
+    cursor.execute(
+        SQL(
+            "UPDATE {} SET completed = true, updated_at = now() WHERE source_layer = %s"
+        ).format(Identifier(schema, "ingest_files")),
+        (source_layer,),
+    )
+    cursor.execute(
+        SQL("DELETE FROM {} WHERE source_layer = %s").format(
+            Identifier(schema, "ingest_seen")
+        ),
+        (source_layer,),
+    )
+
+
+def _ensure_table(cursor, schema: str, table: str, types: dict[str, str]):
+    """Create a target table, or add columns that are new in this delivery"""
+    target = Identifier(schema, table)
+    columns = SQL(", ").join(
+        SQL("{} {}").format(Identifier(name), SQL(_type))
+        for name, _type in types.items()
+    )
+    cursor.execute(SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(target, columns))
+    for name, _type in types.items():
+        cursor.execute(
+            SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}").format(
+                target, Identifier(name), SQL(_type)
+            )
+        )
+    cursor.execute(
+        SQL("CREATE INDEX IF NOT EXISTS {} ON {} (source_layer, feature_hash)").format(
+            Identifier(f"{table}_feature_hash_idx"), target
+        )
+    )
+    cursor.execute(
+        SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING gist (geometry)").format(
+            Identifier(f"{table}_geometry_idx"), target
+        )
+    )
+
+
+def _merge_batch(cursor, schema: str, table: str, df) -> int:
+    """Insert the features of a batch that are not already in the table.
+
+    Returns the number of rows inserted.
+    """
+    target = Identifier(schema, table)
+    incoming = table + "__incoming"
+    columns = SQL(", ").join(Identifier(name) for name in df.columns)
+    cursor.execute(
+        SQL("CREATE TEMPORARY TABLE IF NOT EXISTS {} (LIKE {})").format(
+            Identifier(incoming), target
+        )
+    )
+    copy_frame(cursor, df.drop(columns="feature_hash"), "pg_temp", incoming)
+
+    # The hash ignores null attributes, so that new, empty columns don't change it
+    cursor.execute(
+        SQL(
+            """
+            UPDATE {incoming} t SET feature_hash = md5(
+              coalesce(ST_AsEWKB(t.geometry), '') ||
+              convert_to(jsonb_strip_nulls(to_jsonb(t) - 'geometry' - 'feature_hash')::text, 'UTF8')
+            );
+            INSERT INTO {seen} (source_layer, feature_hash)
+            SELECT DISTINCT source_layer, feature_hash FROM {incoming}
+            ON CONFLICT DO NOTHING;
+            """
+        ).format(
+            incoming=Identifier(incoming),
+            seen=Identifier(schema, "ingest_seen"),
+        )
+    )
+    cursor.execute(
+        SQL(
+            """
+            INSERT INTO {target} ({columns})
+            SELECT {columns} FROM {incoming} t
+            WHERE NOT EXISTS (
+              SELECT 1 FROM {target} e
+              WHERE e.source_layer = t.source_layer
+                AND e.feature_hash = t.feature_hash
+            )
+            """
+        ).format(target=target, columns=columns, incoming=Identifier(incoming))
+    )
+    inserted = cursor.rowcount
+    cursor.execute(SQL("TRUNCATE {}").format(Identifier(incoming)))
+    return inserted
+
+
+def _delete_vanished(cursor, schema: str, table: str, source_layer: str) -> int:
+    """Delete features of a layer that were not seen in the new delivery"""
+    cursor.execute(
+        SQL(
+            """
+            DELETE FROM {target} t
+            WHERE t.source_layer = {layer}
+              AND NOT EXISTS (
+                SELECT 1 FROM {seen} s
+                WHERE s.source_layer = t.source_layer
+                  AND s.feature_hash = t.feature_hash
+              )
+            """
+        ).format(
+            target=Identifier(schema, table),
+            layer=Literal(source_layer),
+            seen=Identifier(schema, "ingest_seen"),
+        )
+    )
+    return cursor.rowcount
+
+
+def _delete_missing_layers(
+    cursor, schema: str, table: str, delivered: list[str]
+) -> dict[str, int]:
+    """Delete features of layers that are not in the delivery, counted by layer"""
+    cursor.execute(
+        SQL(
+            """
+            WITH deleted AS (
+              DELETE FROM {target}
+              WHERE source_layer <> ALL(%s)
+              RETURNING source_layer
+            )
+            SELECT source_layer, count(*) FROM deleted GROUP BY source_layer
+            """
+        ).format(target=Identifier(schema, table)),
+        (delivered,),
+    )
+    return dict(cursor.fetchall())
+
+
+def _forget_missing_layers(cursor, schema: str, delivered: list[str]):
+    for table in ("ingest_files", "ingest_seen"):
+        cursor.execute(
+            SQL("DELETE FROM {} WHERE source_layer <> ALL(%s)").format(
+                Identifier(schema, table)
+            ),
+            (delivered,),
+        )
+
+
+def _existing_tables(cursor, schema: str, slug: str) -> set[str]:
+    names = {table_name(slug, t) for t in ("Polygon", "LineString", "Point")}
+    cursor.execute(
+        """
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = %s AND column_name = 'feature_hash'
+        """,
+        (schema,),
+    )
+    return {row[0] for row in cursor.fetchall()} & names
@@ -0,0 +1,112 @@
+"""
+Fast access to per-layer feature statistics.
+
+Statistics are maintained by the triggers in `fixtures/layer-stats.sql`,
+so these lookups don't scan the feature tables. Projects whose fixtures
+predate the statistics table fall back to scanning.
+"""
+
+from typing import Optional
+
+from macrostrat.database import Database
+
+
+def has_layer_stats(db: Database, schema: str = None) -> bool:
+    """Whether the project maintains layer statistics"""
+    if schema is None:
+        schema = "{data_schema}"
+    return db.run_query(
+        f"SELECT to_regclass('{schema}.layer_stats_current') IS NOT NULL"
+    ).scalar()
+
+
+def get_layer_stats(db: Database, map_layer: Optional[int] = None):
+    """Feature counts, total length and area for each layer, table and type"""
+    if not has_layer_stats(db):
+        return _scan_layer_stats(db, map_layer)
+    return db.run_query(
+        """
+        SELECT
+          s.map_layer,
+          ml.name layer_name,
+          s.feature_table,
+          s.type,
+          s.n_features,
+          s.total_length,
+          s.total_area
+        FROM {data_schema}.layer_stats_current s
+        LEFT JOIN {data_schema}.map_layer ml
+          ON ml.id = s.map_layer
+        WHERE (cast(:map_layer AS integer) IS NULL OR s.map_layer = :map_layer)
+          AND s.n_features > 0
+        ORDER BY s.map_layer, s.feature_table, s.type
+        """,
+        params={"map_layer": map_layer},
+    ).all()
+
+
+def _scan_layer_stats(db: Database, map_layer: Optional[int] = None):
+    return db.run_query(
+        """
+        SELECT
+          s.map_layer,
+          ml.name layer_name,
+          s.feature_table,
+          s.type,
+          count(*) n_features,
+          coalesce(sum(ST_Length(s.geometry)), 0) total_length,
+          coalesce(sum(ST_Area(s.geometry)), 0) total_area
+        FROM (
+          SELECT 'linework' feature_table, map_layer, type, geometry FROM {data_schema}.linework
+          UNION ALL
+          SELECT 'polygon', map_layer, type, geometry FROM {data_schema}.polygon
+        ) s
+        LEFT JOIN {data_schema}.map_layer ml
+          ON ml.id = s.map_layer
+        WHERE (cast(:map_layer AS integer) IS NULL OR s.map_layer = :map_layer)
+          AND s.type IS NOT NULL
+        GROUP BY s.map_layer, ml.name, s.feature_table, s.type
+        ORDER BY s.map_layer, s.feature_table, s.type
+        """,
+        params={"map_layer": map_layer},
+    ).all()
+
+
+def get_layer_extent(db: Database, map_layer: int, feature_table: str = "linework"):
+    """The extent of a layer's features, as `[(xmin, ymin), (xmax, ymax)]`.
+
+    Returns None if the layer has no features.
+    """
+    if has_layer_stats(db):
+        sql = (
+            "SELECT * FROM {data_schema}.layer_stats_extent(:feature_table, :map_layer)"
+        )
+    else:
+        if feature_table not in ("linework", "polygon"):
+            raise ValueError(f"Invalid feature table: {feature_table}")
+        sql = f"""
+        SELECT
+          ST_XMin(e) xmin, ST_YMin(e) ymin, ST_XMax(e) xmax, ST_YMax(e) ymax
+        FROM (
+          SELECT ST_Extent(geometry) e
+          FROM {{data_schema}}.{feature_table}
+          WHERE map_layer = :map_layer
+        ) extent
+        """
+    res = db.run_query(
+        sql,
+        params={"feature_table": feature_table, "map_layer": map_layer},
+    ).one()
+    if res.xmin is None:
+        return None
+    return [(res.xmin, res.ymin), (res.xmax, res.ymax)]
+
+
+def count_features(db: Database, feature_table: str, schema: str = None) -> int:
+    """The number of features with a layer and type in the linework or polygon table"""
+    if schema is None:
+        schema = "{data_schema}"
+    return db.run_query(
+        f"SELECT coalesce(sum(n_features), 0) FROM {schema}.layer_stats_current WHERE feature_table = :feature_table",
+        params={"feature_table": feature_table},
+    ).scalar()
@@ -1,18 +1,27 @@
-from json import dumps
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from json import dumps, loads
 from pathlib import Path
+from queue import Full, Queue
+from threading import Event
+from typing import List, Optional
 
 from geoalchemy2 import Geometry
 from macrostrat.database import Database, run_sql
 from rich import print
-from rich.progress import Progress
 from rich.traceback import install
-from sqlalchemy import MetaData, create_engine
+from sqlalchemy import MetaData, create_engine, text
 from sqlalchemy.event import listen
-from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.sql import insert
 
 from mapboard.core.settings import connection_string
+from mapboard.core.task_runner.progress import get_progress
+
+from ..layer_stats import count_features as layer_feature_count
+from ..layer_stats import has_layer_stats
+from .tiles import export_tiles
 
 install(show_locals=True)
 
@@ -21,20 +30,53 @@ install(show_locals=True)
 # https://github.com/pyenv/pyenv/issues/1702
 
 
-def export_database(project: str, output: Path, overwrite: bool = False):
-    """Export a Mapboard project database to a Spatialite file"""
+def export_database(
+    project: str,
+    output: Path,
+    overwrite: bool = False,
+    batch_size: int = 5000,
+    jobs: int = 4,
+    since: Optional[Path] = None,
+    bbox: Optional[str] = None,
+    layer: Optional[List[int]] = None,
+    area: Optional[Path] = None,
+    tiles: bool = False,
+    min_zoom: int = 0,
+    max_zoom: int = 12,
+):
+    """Export a Mapboard project database to a Spatialite file.
+
+    With --since, only features changed after the given package was exported
+    are written, to a .mapboard-changeset file that can be applied to the
+    package with `apply-changeset`.
+
+    Exports can be limited to features within a --bbox (xmin,ymin,xmax,ymax in
+    the project's SRID), in given map layers (--layer, repeatable), or
+    intersecting the polygons of a GeoJSON --area.
+
+    With --tiles, linework and polygons are also pre-rendered into a vector
+    tile pyramid (tiles.mbtiles) between --min-zoom and --max-zoom. Tiles left
+    from an earlier export into the same package are only rewritten if changed.
+    """
+    subset = dict(bbox=bbox, layers=layer, area=area)
+    if since is not None:
+        return export_changeset(
+            project,
+            since,
+            output,
+            overwrite=overwrite,
+            batch_size=batch_size,
+            jobs=jobs,
+            **subset,
+        )
+
     if not output.parent.exists():
         raise ValueError(f"No such directory: {output.parent}")
 
     if not output.suffix == ".mapboard-project":
         raise ValueError(f"Output file must have .mapboard-project extension")
 
-    # Check if project exists
-    conn_string = connection_string(project)
-    db = Database(conn_string)
-    db.run_query("SELECT 1")
-    db.session.close()
-    print(f"Database [bold]{project}[/bold] exists!")
+    db = connect_project(project)
 
     # Create spatialite file
     print(f"Creating Mapboard project package at [bold]{output}[/bold]...")
@@ -44,11 +86,324 @@ def export_database(project: str, output: Path, overwrite: bool = False):
     if db_path.exists() and overwrite:
         db_path.unlink()
 
-    SRID: int = db.run_query(
+    SRID = get_srid(db)
+    # Taken before reading any data, so that no later change can be missed
+    watermark = get_watermark(db)
+
+    # Ideally this would be synthesized automatically by the app, but it isn't yet
+    backend_config = {"type": "Spatialite", "address": "file:///unknown", "srid": SRID}
+    config = {
+        "backend": dumps(backend_config),
+        "name": output.stem,
+        "location": "Unknown",
+        "export_watermark": watermark,
+    }
+    engine = create_package_database(db_path, SRID, config)
+
+    # Tables are always written in the same order, so that output is reproducible
+    filters, params = subset_filters(SRID, **subset)
+    tables = list(table_queries(filters))
+    copy_tables(
+        db,
+        engine,
+        tables,
+        SRID,
+        batch_size=batch_size,
+        jobs=jobs,
+        params=params,
+        count_features=len(params) == 0,
+    )
+    finish_package(engine)
+
+    if tiles:
+        export_tiles(
+            db,
+            output / "tiles.mbtiles",
+            SRID,
+            min_zoom=min_zoom,
+            max_zoom=max_zoom,
+            filters=filters,
+            params=params,
+            jobs=jobs,
+        )
+
+
+def export_changeset(
+    project: str,
+    package: Path,
+    output: Path,
+    overwrite: bool = False,
+    batch_size: int = 5000,
+    jobs: int = 4,
+    bbox: Optional[str] = None,
+    layers: Optional[List[int]] = None,
+    area: Optional[Path] = None,
+):
+    """Export the features changed since a package was created.
+
+    The package should have been exported with the same subset options.
+    Features that changed such that they no longer match the subset are
+    listed as deleted, so that they are removed from the package.
+    """
+    if not output.suffix == ".mapboard-changeset":
+        raise ValueError("Output file must have .mapboard-changeset extension")
+    if output.exists():
+        if not overwrite:
+            raise ValueError(f"{output} already exists")
+        output.unlink()
+
+    base = get_config(package / "mapboard.db", "export_watermark")
+    if base is None:
+        raise ValueError(
+            f"{package} does not record when it was exported, so changes can't be computed"
+        )
+    base = int(base)
+
+    db = connect_project(project)
+    SRID = get_srid(db)
+    watermark = get_watermark(db)
+    if watermark is None:
+        raise ValueError(f"Project {project} does not track feature changes")
+    horizon = get_pruned_horizon(db)
+    if horizon is not None and base <= horizon:
+        raise ValueError(
+            f"Changes since {package} was exported have been pruned, so it must be exported again"
+        )
+
+    print(f"Creating changeset at [bold]{output}[/bold]...")
+    config = {"base_watermark": str(base), "export_watermark": watermark}
+    engine = create_package_database(output, SRID, config)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE deleted_features (feature_table TEXT NOT NULL, id INTEGER NOT NULL)"
+            )
+        )
+
+    # Layers and types are small, so they are always sent in full
+    filters, params = subset_filters(SRID, bbox=bbox, layers=layers, area=area)
+    tables = []
+    for name, sql in table_queries(filters):
+        if name in ("linework", "polygon"):
+            sql = _changed_since(sql, name, base)
+        tables.append((name, sql))
+    tables.append(("deleted_features", _deleted_since(base, filters)))
+    copy_tables(
+        db,
+        engine,
+        tables,
+        SRID,
+        batch_size=batch_size,
+        jobs=jobs,
+        params=params,
+        count_features=False,
+    )
+
+
+def apply_changeset(package: Path, changeset: Path):
+    """Apply a changeset to a Mapboard project package"""
+    db_path = package / "mapboard.db"
+    current = int(get_config(db_path, "export_watermark") or -1)
+    base = int(get_config(changeset, "base_watermark"))
+    watermark = int(get_config(changeset, "export_watermark"))
+    if current < base:
+        raise ValueError("Package is older than the export this changeset is based on")
+    if current > watermark:
+        raise ValueError("Package is newer than this changeset")
+
+    engine = setup_spatialite(db_path)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS changes", (str(changeset),))
+        for table_name, _ in table_queries():
+            cursor.execute(
+                f"INSERT OR REPLACE INTO main.{table_name} SELECT * FROM changes.{table_name}"
+            )
+        for table_name in ("linework", "polygon"):
+            cursor.execute(
+                f"""
+                DELETE FROM main.{table_name} WHERE id IN (
+                  SELECT id FROM changes.deleted_features WHERE feature_table = ?
+                )
+                """,
+                (table_name,),
+            )
+        cursor.execute(
+            "UPDATE main.mapboard_config SET value = ? WHERE key = 'export_watermark'",
+            (str(watermark),),
+        )
+        conn.commit()
+        cursor.execute("DETACH DATABASE changes")
+    finally:
+        conn.close()
+    print(f"Applied [bold]{changeset}[/bold] to [bold]{package}[/bold]")
+
+
+def connect_project(project: str) -> Database:
+    # Check if project exists
+    conn_string = connection_string(project)
+    db = Database(conn_string)
+    db.run_query("SELECT 1")
+    db.session.close()
+    print(f"Database [bold]{project}[/bold] exists!")
+    return db
+
+
+def get_srid(db: Database) -> int:
+    return db.run_query(
         "SELECT srid FROM geometry_columns WHERE f_table_schema = :schema AND f_table_name = :table",
         params=dict(schema="mapboard", table="polygon"),
     ).scalar()
 
+
+def get_watermark(db: Database) -> Optional[str]:
+    """The oldest transaction whose changes might not be visible to a new export.
+
+    Returns None if the project does not track feature changes.
+    """
+    return db.run_query(
+        """
+        SELECT CASE WHEN to_regclass('mapboard.feature_changes') IS NOT NULL
+          THEN pg_snapshot_xmin(pg_current_snapshot())::text
+        END
+        """
+    ).scalar()
+
+
+def get_pruned_horizon(db: Database) -> Optional[int]:
+    """The newest transaction whose feature changes have been pruned, if any"""
+    exists = db.run_query(
+        "SELECT to_regclass('mapboard.feature_changes_horizon') IS NOT NULL"
+    ).scalar()
+    if not exists:
+        return None
+    horizon = db.run_query(
+        "SELECT xid::text FROM mapboard.feature_changes_horizon"
+    ).scalar()
+    if horizon is None:
+        return None
+    return int(horizon)
+
+
+def get_config(db_path: Path, key: str) -> Optional[str]:
+    """Read a value from the config table of a package or changeset"""
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT value FROM mapboard_config WHERE key = ?", (key,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return row[0]
+
+
+def table_queries(filters: str = "true"):
+    """The queries for each exported table, in the order they are written.
+
+    `filters` is a condition on the features to export.
+    """
+    table_queries = Path(__file__).parent / "table_queries"
+    for f in sorted(table_queries.glob("*.sql")):
+        sql = f.read_text().replace("{filters}", filters)
+        yield f.stem.replace("-", "_"), sql
+
+
+def subset_filters(
+    SRID: int,
+    bbox: Optional[str] = None,
+    layers: Optional[List[int]] = None,
+    area: Optional[Path] = None,
+) -> tuple[str, dict]:
+    """Build a condition selecting a spatial or thematic subset of features.
+
+    The conditions are applied in the source queries, so that they can use the
+    project's indexes.
+    """
+    filters = []
+    params = {}
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = (float(v) for v in bbox.split(","))
+        filters.append(
+            f"geometry && ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, {SRID:d})"
+        )
+        params.update(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+    if layers:
+        filters.append("map_layer = ANY(:layers)")
+        params["layers"] = list(layers)
+    if area is not None:
+        # GeoJSON coordinates are always longitude and latitude
+        filters.append(
+            f"""ST_Intersects(geometry, ST_Transform(
+              ST_SetSRID(ST_GeomFromGeoJSON(:area), 4326), {SRID:d}
+            ))"""
+        )
+        params["area"] = _area_geometry(area)
+    if len(filters) == 0:
+        return "true", params
+    return " AND ".join(filters), params
+
+
+def _area_geometry(path: Path) -> str:
+    """The geometry of a GeoJSON file, as a single GeoJSON geometry"""
+    data = loads(path.read_text())
+    if data.get("type") == "FeatureCollection":
+        geometries = [feature["geometry"] for feature in data["features"]]
+        data = {"type": "GeometryCollection", "geometries": geometries}
+    elif data.get("type") == "Feature":
+        data = data["geometry"]
+    return dumps(data)
+
+
+def finish_package(engine):
+    """Build spatial indexes and query planner statistics for a filled package"""
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for table_name in ("linework", "polygon"):
+            cursor.execute(f"SELECT CreateSpatialIndex('{table_name}', 'geometry')")
+        cursor.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _changed_since(sql: str, table_name: str, watermark: int) -> str:
+    return f"""
+    SELECT q.* FROM ({sql.strip().rstrip(";")}) q
+    WHERE q.id IN (
+      SELECT feature_id FROM mapboard.feature_changes
+      WHERE feature_table = '{table_name}'
+        AND xid >= '{watermark:d}'::xid8
+    )
+    ORDER BY q.id
+    """
+
+
+def _deleted_since(watermark: int, filters: str = "true") -> str:
+    """Changed features that were deleted, or no longer match the subset filters"""
+    return f"""
+    SELECT DISTINCT c.feature_table, c.feature_id id
+    FROM mapboard.feature_changes c
+    WHERE c.xid >= '{watermark:d}'::xid8
+      AND CASE c.feature_table
+        WHEN 'linework' THEN NOT EXISTS (
+          SELECT 1 FROM mapboard.linework
+          WHERE id = c.feature_id AND ({filters})
+        )
+        WHEN 'polygon' THEN NOT EXISTS (
+          SELECT 1 FROM mapboard.polygon
+          WHERE id = c.feature_id AND ({filters})
+        )
+      END
+    ORDER BY c.feature_table, id
+    """
+
+
+def create_package_database(db_path: Path, SRID: int, config: dict):
+    """Create a Spatialite database with the Mapboard app's schema"""
     # Basically the same as macrostrat.database but Spatialite
     engine = setup_spatialite(db_path)
     session_factory = sessionmaker(bind=engine)
@@ -69,16 +424,10 @@ def export_database(project: str, output: Path, overwrite: bool = False):
     meta.tables["linework"].c.geometry.type = Geometry("MULTILINESTRING", srid=SRID)
     cfg = meta.tables["mapboard_config"]
 
-    # Ideally this would be synthesized automatically by the app, but it isn't yet
-    backend_config = {"type": "Spatialite", "address": "file:///unknown", "srid": SRID}
-    config = {
-        "backend": dumps(backend_config),
-        "name": output.stem,
-        "location": "Unknown",
-    }
-
     stmt = insert(cfg)
     for key, value in config.items():
+        if value is None:
+            continue
         session.execute(stmt.values(key=key, value=value))
     session.commit()
 
@@ -91,28 +440,180 @@ def export_database(project: str, output: Path, overwrite: bool = False):
         session.execute(stmt.values(identifier=migration))
     session.commit()
 
-    table_queries = Path(__file__).parent / "table_queries"
-    with Progress() as progress:
-        for f in table_queries.glob("*.sql"):
-            sql = f.read_text()
-            query = db.run_query(sql)
-            table_name = f.stem.replace("-", "_")
-            tbl = meta.tables[table_name]
-            insert_stmt = insert(tbl)
-            nrows = db.run_query(
-                "SELECT count(*) FROM mapboard." + table_name
-            ).scalar_one()
-
-            # rich progress bar
-            task = progress.add_task(f"Table [bold]{table_name}[/bold]", total=nrows)
-
-            for row in query:
-                try:
-                    session.execute(insert_stmt, row._mapping)
-                except IntegrityError as e:
-                    print(e)
-                progress.update(task, advance=1)
-            session.commit()
+    session.close()
+    return engine
+
+
+def copy_tables(
+    db: Database,
+    engine,
+    tables: list[tuple[str, str]],
+    SRID: int,
+    batch_size: int = 5000,
+    jobs: int = 4,
+    params: Optional[dict] = None,
+    count_features: bool = True,
+):
+    """Copy the results of table queries into a Spatialite database.
+
+    If `count_features` is set, progress for feature tables is sized from the
+    layer statistics, which only applies if whole tables are copied.
+    """
+    has_stats = count_features and has_layer_stats(db, schema="mapboard")
+
+    conn = engine.raw_connection()
+    try:
+        with bulk_load_pragmas(conn), get_progress() as progress:
+            tasks = {}
+            for table_name, _ in tables:
+                nrows = None
+                if has_stats and table_name in ("linework", "polygon"):
+                    nrows = layer_feature_count(db, table_name, schema="mapboard")
+                # rich progress bar
+                tasks[table_name] = progress.add_task(
+                    f"Table [bold]{table_name}[/bold]", total=nrows
+                )
+
+            insert_sql = {}
+            batches = read_tables(db, tables, batch_size, jobs, params=params)
+            for table_name, columns, rows in batches:
+                if table_name not in insert_sql:
+                    insert_sql[table_name] = insert_statement(table_name, columns, SRID)
+                write_batch(conn, insert_sql[table_name], rows)
+                progress.update(tasks[table_name], advance=len(rows))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def read_tables(
+    db: Database,
+    tables: list[tuple[str, str]],
+    batch_size: int = 5000,
+    jobs: int = 4,
+    queue_size: int = 4,
+    params: Optional[dict] = None,
+):
+    """Read several table queries concurrently, yielding batches in table order.
+
+    Each table is read by its own thread (at most `jobs` at once) into a queue
+    holding up to `queue_size` batches. Batches are yielded table by table, in
+    the order given, so the single consumer sees exactly the same sequence of
+    rows as a serial read while later tables are prefetched in the background.
+    """
+    stop = Event()
+    queues = [Queue(maxsize=queue_size) for _ in tables]
+
+    def read_table(sql: str, queue: Queue):
+        try:
+            for batch in read_batches(db, sql, batch_size, params):
+                if not _put(queue, batch, stop):
+                    return
+            _put(queue, _done, stop)
+        except Exception as err:
+            _put(queue, err, stop)
+
+    # Tables are submitted in order, so the table being written is always being read
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for (_, sql), queue in zip(tables, queues):
+            executor.submit(read_table, sql, queue)
+        try:
+            for (table_name, _), queue in zip(tables, queues):
+                while (item := queue.get()) is not _done:
+                    if isinstance(item, Exception):
+                        raise item
+                    columns, rows = item
+                    yield table_name, columns, rows
+        finally:
+            # Unblock readers if the consumer stops early
+            stop.set()
+
+
+_done = object()
+
+
+def _put(queue: Queue, item, stop: Event) -> bool:
+    """Put an item on a bounded queue, giving up if the consumer has stopped"""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.5)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def read_batches(
+    db: Database,
+    sql: str,
+    batch_size: int = 5000,
+    params: Optional[dict] = None,
+):
+    """Stream the results of a query from a server-side cursor, in batches.
+
+    Yields the column names and a list of rows for each batch.
+    """
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            text(sql), params or {}
+        )
+        columns = list(result.keys())
+        for rows in result.partitions(batch_size):
+            yield columns, [_sqlite_row(row) for row in rows]
+
+
+def _sqlite_row(row):
+    # Binary columns arrive from psycopg2 as memoryviews
+    return tuple(bytes(v) if isinstance(v, memoryview) else v for v in row)
+
+
+def insert_statement(table_name: str, columns: list[str], srid: int) -> str:
+    """An INSERT statement for a Spatialite table, with geometries passed as WKB"""
+    values = [
+        f"GeomFromWKB(?, {srid:d})" if column == "geometry" else "?"
+        for column in columns
+    ]
+    return (
+        f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(values)})"
+    )
+
+
+def write_batch(conn, insert_sql: str, rows: list[tuple]):
+    """Insert a batch of rows, falling back to one row at a time if any row is rejected"""
+    cursor = conn.cursor()
+    cursor.execute("SAVEPOINT batch")
+    try:
+        cursor.executemany(insert_sql, rows)
+    except sqlite3.IntegrityError:
+        cursor.execute("ROLLBACK TO batch")
+        for row in rows:
+            try:
+                cursor.execute(insert_sql, row)
+            except sqlite3.IntegrityError as e:
+                print(e)
+    cursor.execute("RELEASE batch")
+
+
+# Settings for loading a fresh database that can simply be recreated on failure
+_bulk_load_pragmas = {
+    "journal_mode": ("MEMORY", "DELETE"),
+    "synchronous": ("OFF", "FULL"),
+    "cache_size": (-256000, -2000),
+    "temp_store": ("MEMORY", "DEFAULT"),
+}
+
+
+@contextmanager
+def bulk_load_pragmas(conn):
+    """Relax SQLite's durability guarantees for the duration of a bulk load"""
+    cursor = conn.cursor()
+    for pragma, (value, _) in _bulk_load_pragmas.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    try:
+        yield
+    finally:
+        for pragma, (_, value) in _bulk_load_pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
 
 
 def setup_spatialite(db_path: Path):
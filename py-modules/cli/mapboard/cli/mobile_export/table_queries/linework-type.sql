@@ -1 +1,2 @@
-SELECT id, name, color, 'main' topology FROM mapboard.linework_type;
\ No newline at end of file
+SELECT id, name, color, 'main' topology FROM mapboard.linework_type
+ORDER BY id;
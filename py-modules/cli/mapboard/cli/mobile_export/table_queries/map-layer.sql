@@ -5,4 +5,5 @@ SELECT
   topological,
   parent,
   position
-FROM mapboard.map_layer;
\ No newline at end of file
+FROM mapboard.map_layer
+ORDER BY id;
@@ -1 +1,2 @@
-SELECT id, name, color, 'main' topology FROM mapboard.polygon_type
\ No newline at end of file
+SELECT id, name, color, 'main' topology FROM mapboard.polygon_type
+ORDER BY id;
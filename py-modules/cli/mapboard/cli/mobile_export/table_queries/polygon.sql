@@ -1,9 +1,11 @@
 SELECT id,
-       ST_AsEWKT(geometry) geometry,
+       ST_AsBinary(geometry) geometry,
        certainty,
        type,
        map_width,
        pixel_width,
        created,
        map_layer           layer
-FROM mapboard.polygon;
+FROM mapboard.polygon
+WHERE {filters}
+ORDER BY id;
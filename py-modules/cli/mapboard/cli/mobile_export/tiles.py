@@ -0,0 +1,319 @@
+"""
+Pre-rendered vector tiles for project packages.
+
+Linework and polygons are rendered into Mapbox Vector Tiles by PostGIS
+(`ST_AsMVT`) and stored in an MBTiles file alongside the package database,
+so the app doesn't have to simplify full-resolution geometries on the fly.
+Each feature's `zoom_level` and `pixel_width` are carried as tile attributes,
+for styling and for hiding detail digitized at higher zooms.
+Tiles are rendered in parallel, and a hash of each tile is kept so that
+re-exports only rewrite the tiles that changed.
+"""
+
+import sqlite3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from gzip import compress
+from itertools import islice
+from json import dumps
+from math import atan, degrees, exp, floor, pi
+from pathlib import Path
+
+from macrostrat.database import Database
+from rich import print
+from sqlalchemy import text
+
+from mapboard.core.task_runner.progress import get_progress
+
+# Half the width of the web mercator world, in meters
+_world = 20037508.342789244
+
+_extent = 4096
+
+
+def export_tiles(
+    db: Database,
+    output: Path,
+    SRID: int,
+    min_zoom: int = 0,
+    max_zoom: int = 12,
+    filters: str = "true",
+    params: dict = None,
+    jobs: int = 4,
+    batch_size: int = 256,
+):
+    """Render a project's features into an MBTiles file.
+
+    Tiles already present in `output` are only rewritten if their content changed.
+    """
+    bounds = project_bounds(db, SRID, filters, params)
+    if bounds is None:
+        print("No features to render into tiles")
+        return
+
+    conn = sqlite3.connect(output)
+    try:
+        _create_tables(conn)
+        _write_metadata(conn, bounds, min_zoom, max_zoom)
+        known = {
+            (z, x, y): hash
+            for z, x, y, hash in conn.execute(
+                "SELECT zoom_level, tile_column, tile_row, hash FROM tile_hashes"
+            )
+        }
+
+        tiles = [
+            tile
+            for z in range(min_zoom, max_zoom + 1)
+            for tile in tile_range(z, bounds)
+        ]
+        sql = text(_tile_query(SRID, filters))
+
+        def render(batch):
+            with db.engine.connect() as pg:
+                return [
+                    _render_tile(pg, sql, params, tile, known.get(_tms(*tile)))
+                    for tile in batch
+                ]
+
+        written = 0
+        with get_progress() as progress:
+            task = progress.add_task("Rendering tiles", total=len(tiles))
+            for results in _bounded_map(render, _batches(tiles, batch_size), jobs):
+                for tile, hash, data in results:
+                    key = _tms(*tile)
+                    if hash is None:
+                        _delete_tile(conn, key)
+                    elif data is not None:
+                        _write_tile(conn, key, hash, data)
+                        written += 1
+                conn.commit()
+                progress.update(task, advance=len(results))
+
+        # Drop tiles outside of the current bounds or zoom levels
+        rendered = {_tms(*tile) for tile in tiles}
+        for key in known.keys() - rendered:
+            _delete_tile(conn, key)
+        conn.commit()
+        print(f"Wrote {written} changed tiles to [bold]{output}[/bold]")
+    finally:
+        conn.close()
+
+
+def project_bounds(db: Database, SRID: int, filters: str = "true", params: dict = None):
+    """The extent of the project's features that match `filters`, in web mercator
+
+    The extent of an unfiltered export is read from the layer statistics.
+    """
+    has_stats = (
+        filters == "true"
+        and db.run_query(
+            "SELECT to_regclass('mapboard.layer_stats_current') IS NOT NULL"
+        ).scalar()
+    )
+    if has_stats:
+        extent = """
+        SELECT ST_MakeEnvelope(min(xmin), min(ymin), max(xmax), max(ymax), :srid) geom
+        FROM mapboard.layer_stats_current
+        WHERE n_features > 0
+        """
+    else:
+        extent = f"""
+        SELECT ST_SetSRID(ST_Extent(geometry), :srid) geom FROM (
+          SELECT geometry FROM mapboard.linework WHERE {filters}
+          UNION ALL
+          SELECT geometry FROM mapboard.polygon WHERE {filters}
+        ) features
+        """
+    res = db.run_query(
+        f"""
+        WITH extent AS ({extent})
+        SELECT
+          ST_XMin(b) xmin, ST_YMin(b) ymin, ST_XMax(b) xmax, ST_YMax(b) ymax
+        FROM extent, ST_Transform(extent.geom, 3857) b
+        """,
+        params=dict(params or {}, srid=SRID),
+    ).one()
+    if res.xmin is None:
+        return None
+    return (res.xmin, res.ymin, res.xmax, res.ymax)
+
+
+def tile_range(z: int, bounds):
+    """The XYZ tiles at a zoom level that cover web mercator bounds"""
+    n = 2**z
+
+    def index(value):
+        return min(max(floor((value + _world) / (2 * _world) * n), 0), n - 1)
+
+    x0, x1 = index(bounds[0]), index(bounds[2])
+    # Tile rows count down from the top of the map
+    y0, y1 = n - 1 - index(bounds[3]), n - 1 - index(bounds[1])
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield (z, x, y)
+
+
+def _tile_query(SRID: int, filters: str) -> str:
+    columns = """
+      f.id,
+      f.type,
+      f.map_layer layer,
+      f.certainty,
+      f.pixel_width,
+      f.map_width,
+      f.zoom_level
+    """
+    return f"""
+    WITH bounds AS (
+      SELECT
+        ST_TileEnvelope(:z, :x, :y) tile,
+        ST_Transform(ST_TileEnvelope(:z, :x, :y), {SRID:d}) envelope
+    ),
+    linework AS (
+      SELECT
+        ST_AsMVTGeom(ST_Transform(f.geometry, 3857), b.tile, {_extent}) geom,
+        {columns}
+      FROM mapboard.linework f, bounds b
+      WHERE f.geometry && b.envelope
+        AND {filters}
+    ),
+    polygon AS (
+      SELECT
+        ST_AsMVTGeom(ST_Transform(f.geometry, 3857), b.tile, {_extent}) geom,
+        {columns}
+      FROM mapboard.polygon f, bounds b
+      WHERE f.geometry && b.envelope
+        AND {filters}
+    ),
+    tile AS (
+      SELECT
+        (SELECT ST_AsMVT(polygon, 'polygon', {_extent}, 'geom') FROM polygon WHERE geom IS NOT NULL) ||
+        (SELECT ST_AsMVT(linework, 'linework', {_extent}, 'geom') FROM linework WHERE geom IS NOT NULL) mvt
+    )
+    SELECT
+      CASE WHEN length(mvt) > 0 THEN md5(mvt) END hash,
+      CASE WHEN length(mvt) > 0 AND md5(mvt) IS DISTINCT FROM :known THEN mvt END mvt
+    FROM tile
+    """
+
+
+def _render_tile(pg, sql, params: dict, tile, known_hash):
+    """Render a tile, returning its hash and data.
+
+    The data is omitted if it matches the known hash, and the hash is None
+    if the tile is empty.
+    """
+    z, x, y = tile
+    query_params = dict(params or {}, z=z, x=x, y=y, known=known_hash)
+    res = pg.execute(sql, query_params).one()
+    data = None
+    if res.mvt is not None:
+        data = compress(bytes(res.mvt), mtime=0)
+    return tile, res.hash, data
+
+
+def _tms(z: int, x: int, y: int):
+    """MBTiles rows count up from the bottom of the map"""
+    return (z, x, 2**z - 1 - y)
+
+
+def _create_tables(conn):
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS tiles (
+          zoom_level INTEGER,
+          tile_column INTEGER,
+          tile_row INTEGER,
+          tile_data BLOB,
+          PRIMARY KEY (zoom_level, tile_column, tile_row)
+        );
+        CREATE TABLE IF NOT EXISTS tile_hashes (
+          zoom_level INTEGER,
+          tile_column INTEGER,
+          tile_row INTEGER,
+          hash TEXT,
+          PRIMARY KEY (zoom_level, tile_column, tile_row)
+        );
+        """
+    )
+
+
+def _write_metadata(conn, bounds, min_zoom: int, max_zoom: int):
+    west, south = _lon_lat(bounds[0], bounds[1])
+    east, north = _lon_lat(bounds[2], bounds[3])
+    fields = {
+        "id": "Number",
+        "type": "String",
+        "layer": "Number",
+        "certainty": "Number",
+        "pixel_width": "Number",
+        "map_width": "Number",
+        "zoom_level": "Number",
+    }
+    vector_layers = [
+        dict(id=name, fields=fields, minzoom=min_zoom, maxzoom=max_zoom)
+        for name in ("polygon", "linework")
+    ]
+    metadata = {
+        "name": "mapboard",
+        "format": "pbf",
+        "type": "overlay",
+        "minzoom": str(min_zoom),
+        "maxzoom": str(max_zoom),
+        "bounds": f"{west},{south},{east},{north}",
+        "center": f"{(west + east) / 2},{(south + north) / 2},{min_zoom}",
+        "json": dumps(dict(vector_layers=vector_layers)),
+    }
+    conn.executemany(
+        "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+        metadata.items(),
+    )
+    conn.commit()
+
+
+def _lon_lat(x: float, y: float):
+    lon = degrees(x / _world * pi)
+    lat = degrees(2 * atan(exp(y / _world * pi)) - pi / 2)
+    return lon, lat
+
+
+def _write_tile(conn, key, hash: str, data: bytes):
+    conn.execute(
+        "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+        (*key, data),
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO tile_hashes (zoom_level, tile_column, tile_row, hash) VALUES (?, ?, ?, ?)",
+        (*key, hash),
+    )
+
+
+def _delete_tile(conn, key):
+    for table in ("tiles", "tile_hashes"):
+        conn.execute(
+            f"DELETE FROM {table} WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            key,
+        )
+
+
+def _batches(items: list, size: int):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+def _bounded_map(func, items, jobs: int):
+    """Apply a function in a thread pool, with a bounded number of pending calls.
+
+    Results are yielded as they complete.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(func, item) for item in islice(items, 2 * jobs)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for item in islice(items, 1):
+                    pending.add(executor.submit(func, item))
+                yield future.result()
@@ -8,7 +8,11 @@ from numpy import log10
 from mapboard.core.settings import connection_string, core_db
 from mapboard.core.database import setup_database
 from sys import stderr
-from shapely.geometry import MultiLineString
+from mapboard.core.task_runner.progress import get_progress
+from rich.table import Table
+from sqlalchemy.exc import ProgrammingError
+
+from .. import layer_stats
 from .dangling_edges import remove_dangling_edges
 from .composite_layers import update_composite_layers
 
@@ -24,6 +28,8 @@ def create_grid_layer(
     parent: str,
     spacing: Optional[float] = None,
     replace: bool = False,
+    yes: bool = False,
+    batch_size: int = 5000,
 ):
     """Create a grid layer for a Mapboard project"""
 
@@ -73,10 +79,11 @@ def create_grid_layer(
     print(f"Y range: {y_range}")
     print(f"Number of squares: {n}")
 
-    print(f"Are you sure you want to generate {n} squares? (y/n)")
-    if input().lower() != "y":
-        print("Aborting")
-        return
+    if not yes:
+        print(f"Are you sure you want to generate {n} squares? (y/n)")
+        if input().lower() != "y":
+            print("Aborting")
+            return
 
     # Create a grid layer if it doesn't exist
     grid_layer_id = create_layer(db, "Grid", parent=parent_id, topological=True)
@@ -94,38 +101,73 @@ def create_grid_layer(
     # Tolerance to make sure grid edges overlap
     tolerance = 0.01 * spacing
 
-    # Create the grid
-    for i in range(n_x + 1):
-        # Create vertical lines
-        coords = [
-            (x_range[0] + i * spacing, y_range[0] - tolerance),
-            (x_range[0] + i * spacing, y_range[1] + tolerance),
-        ]
-        insert_line(db, coords, grid_layer_id, type_id)
-
-    for i in range(n_y + 1):
-        # Create horizontal lines
-        coords = [
-            (x_range[0] - tolerance, y_range[0] + i * spacing),
-            (x_range[1] + tolerance, y_range[0] + i * spacing),
-        ]
-        insert_line(db, coords, grid_layer_id, type_id)
+    # Create the grid in batches of lines, generated on the server
+    with get_progress() as progress:
+        task = progress.add_task("Creating grid lines", total=n_x + n_y + 2)
+        for vertical, n_lines in ((True, n_x + 1), (False, n_y + 1)):
+            for start in range(0, n_lines, batch_size):
+                stop = min(start + batch_size, n_lines) - 1
+                insert_grid_lines(
+                    db,
+                    vertical=vertical,
+                    start=start,
+                    stop=stop,
+                    x_range=x_range,
+                    y_range=y_range,
+                    spacing=spacing,
+                    tolerance=tolerance,
+                    map_layer=grid_layer_id,
+                    linework_type=type_id,
+                )
+                progress.update(task, advance=stop - start + 1)
 
     db.session.commit()
 
 
-def insert_line(db: Database, coords: list, map_layer: int, linework_type: str):
-    geom = MultiLineString([coords])
-    sql = """
-    INSERT INTO {data_schema}.linework (geometry, map_layer, type)
-    SELECT :geom, :map_layer, :linework_type
+def insert_grid_lines(
+    db: Database,
+    *,
+    vertical: bool,
+    start: int,
+    stop: int,
+    x_range: tuple,
+    y_range: tuple,
+    spacing: float,
+    tolerance: float,
+    map_layer: int,
+    linework_type: str,
+):
+    """Insert grid lines `start` through `stop` in a single statement.
+
+    Vertical lines run along the y range at each multiple of `spacing` from the
+    start of the x range, and horizontal lines the other way around.
+    """
+    if vertical:
+        along, across = y_range, x_range
+        line = "ST_MakeLine(ST_MakePoint(c, :min - :tolerance), ST_MakePoint(c, :max + :tolerance))"
+    else:
+        along, across = x_range, y_range
+        line = "ST_MakeLine(ST_MakePoint(:min - :tolerance, c), ST_MakePoint(:max + :tolerance, c))"
+
+    sql = f"""
+    INSERT INTO {{data_schema}}.linework (geometry, map_layer, type)
+    SELECT ST_SetSRID(ST_Multi({line}), :srid), :map_layer, :linework_type
+    FROM generate_series(:start, :stop) i,
+    LATERAL (SELECT :origin + i * :spacing AS c) coord
     """
     db.run_query(
         sql,
         params={
-            "geom": geom.wkb_hex,
+            "start": start,
+            "stop": stop,
+            "origin": float(across[0]),
+            "min": float(along[0]),
+            "max": float(along[1]),
+            "spacing": float(spacing),
+            "tolerance": float(tolerance),
             "map_layer": map_layer,
             "linework_type": linework_type,
+            "srid": db.instance_params["srid"],
         },
     )
 
@@ -189,20 +231,204 @@ def create_linework_type(db: Database, name: str, layer_id: Optional[int] = None
 
 def get_layer_extent(db: Database, layer_id: int):
     """Get the extent of a layer"""
-    sql = """
-    SELECT st_extent(geometry) FROM {data_schema}.linework WHERE map_layer = :layer_id
+    extent = layer_stats.get_layer_extent(db, layer_id)
+    if extent is None:
+        raise ValueError(f"Layer {layer_id} has no linework")
+    return extent
+
+
+@app.command(name="layer-stats")
+def show_layer_stats(project: str, layer: Optional[str] = None):
+    """Show feature counts and sizes for the layers of a Mapboard project"""
+    db = setup_database(project)
+    layer_id = None
+    if layer is not None:
+        layer_id = get_layer_id(db, layer)
+
+    table = Table("Layer", "Table", "Type", "Features", "Length", "Area")
+    for row in layer_stats.get_layer_stats(db, layer_id):
+        table.add_row(
+            row.layer_name or str(row.map_layer),
+            row.feature_table,
+            row.type,
+            str(row.n_features),
+            f"{row.total_length:.4g}",
+            f"{row.total_area:.4g}",
+        )
+    print(table)
+
+
+def delete_layer_linework(
+    db: Database,
+    layer_id: int,
+    *,
+    batch_size: int = 5000,
+    skip_topology: bool = False,
+):
+    """Delete the linework of a layer in batches, committing after each batch.
+
+    With `skip_topology`, each batch is deleted with `session_replication_role`
+    set to `replica`, so that the topology manager's triggers on the linework
+    table don't run, and the topology relations of the deleted lines are
+    cleaned up once at the end. The setting only applies to the deleting
+    transactions, and triggers marked `ENABLE ALWAYS` (layer statistics and
+    change tracking) still run.
     """
-    res = db.run_query(sql, params={"layer_id": layer_id}).scalar()
-    # Parse coordinates
-    assert res.startswith("BOX(")
-    res = res[4:-1]
-    coords = res.split(",")
-    return [tuple(map(float, c.split())) for c in coords]
+    total = sum(
+        row.n_features
+        for row in layer_stats.get_layer_stats(db, layer_id)
+        if row.feature_table == "linework"
+    )
+
+    triggers = []
+    if skip_topology:
+        triggers = topology_triggers(db)
+        others = [t for t in _replica_skipped_triggers(db) if t not in triggers]
+        if len(others) > 0:
+            print(
+                f"[yellow]Triggers would be skipped that are not part of the topology, deleting with them enabled: {', '.join(others)}"
+            )
+            triggers = []
+        else:
+            print(f"Skipping topology triggers while deleting: {', '.join(triggers)}")
+
+    last_id = -1
+    with get_progress() as progress:
+        task = progress.add_task("Deleting linework", total=total)
+        while True:
+            if len(triggers) > 0:
+                try:
+                    # Only this transaction skips the triggers
+                    db.run_query("SET LOCAL session_replication_role = replica")
+                except ProgrammingError as err:
+                    db.session.rollback()
+                    print(
+                        f"[yellow]Could not skip topology triggers, deleting with them enabled: {err.orig}"
+                    )
+                    triggers = []
+            ids = (
+                db.run_query(
+                    """
+                DELETE FROM {data_schema}.linework
+                WHERE id IN (
+                  SELECT id FROM {data_schema}.linework
+                  WHERE map_layer = :layer_id
+                    AND id > :last_id
+                  ORDER BY id
+                  LIMIT :batch_size
+                )
+                RETURNING id
+                """,
+                    params={
+                        "layer_id": layer_id,
+                        "last_id": last_id,
+                        "batch_size": batch_size,
+                    },
+                )
+                .scalars()
+                .all()
+            )
+            db.session.commit()
+            if len(ids) == 0:
+                break
+            last_id = max(ids)
+            progress.update(task, advance=len(ids))
+
+    if len(triggers) > 0:
+        cleanup_deleted_linework(db)
+
+
+def topology_triggers(db: Database) -> list[str]:
+    """Enabled triggers on the linework table that are managed by the topology"""
+    return (
+        db.run_query(
+            """
+            SELECT t.tgname
+            FROM pg_trigger t
+            JOIN pg_proc p
+              ON p.oid = t.tgfoid
+            WHERE t.tgrelid = '{data_schema}.linework'::regclass
+              AND NOT t.tgisinternal
+              AND t.tgenabled <> 'D'
+              AND p.pronamespace = (
+                SELECT relnamespace FROM pg_class
+                WHERE oid = '{topo_schema}.edge_data'::regclass
+              )
+            ORDER BY t.tgname
+            """
+        )
+        .scalars()
+        .all()
+    )
+
+
+def _replica_skipped_triggers(db: Database) -> list[str]:
+    """Triggers on the linework table that don't fire in replica sessions"""
+    return (
+        db.run_query(
+            """
+            SELECT tgname
+            FROM pg_trigger
+            WHERE tgrelid = '{data_schema}.linework'::regclass
+              AND NOT tgisinternal
+              AND tgenabled = 'O'
+            ORDER BY tgname
+            """
+        )
+        .scalars()
+        .all()
+    )
+
+
+def cleanup_deleted_linework(db: Database):
+    """Do the work of the topology triggers that were skipped while deleting linework"""
+    # Drop topology relations of deleted lines
+    db.run_query(
+        """
+        DELETE FROM {topo_schema}.relation r
+        USING topology.layer tl, pg_class c, pg_namespace n
+        WHERE c.oid = '{data_schema}.linework'::regclass
+          AND n.oid = c.relnamespace
+          AND tl.schema_name = n.nspname
+          AND tl.table_name = c.relname
+          AND tl.feature_column = 'topo'
+          AND r.layer_id = tl.layer_id
+          AND NOT EXISTS (
+            SELECT 1 FROM {data_schema}.linework l
+            WHERE id(l.topo) = r.topogeo_id
+          )
+        """
+    )
+    db.run_query(
+        """
+        DELETE FROM {topo_schema}.__edge_relation er
+        WHERE NOT EXISTS (
+          SELECT 1 FROM {data_schema}.linework l
+          WHERE l.id = er.line_id
+        )
+        """
+    )
+    db.session.commit()
 
 
 @app.command(name="drop-layer")
-def drop_layer(project: str, layer: str, force: bool = False):
-    """Drop a layer from a Mapboard project"""
+def drop_layer(
+    project: str,
+    layer: str,
+    force: bool = False,
+    batch_size: int = 5000,
+    skip_topology: bool = False,
+):
+    """Drop a layer from a Mapboard project.
+
+    With --force, the layer's linework is deleted in batches of --batch-size
+    lines, each in its own transaction, so that other users of the project are
+    not locked out for the duration. --skip-topology skips the topology's
+    per-row triggers while deleting and cleans up the topology once at the end
+    instead. This requires permission to set `session_replication_role`
+    (superuser, or on PostgreSQL 15+ a `GRANT SET ON PARAMETER`); without it,
+    the layer is deleted with the triggers enabled.
+    """
 
     db = setup_database(project)
 
@@ -225,11 +451,8 @@ def drop_layer(project: str, layer: str, force: bool = False):
 
     if force:
         # Drop all geometries in the layer
-        db.run_query(
-            """
-            DELETE FROM {data_schema}.linework WHERE map_layer = :layer_id
-            """,
-            params={"layer_id": layer_id},
+        delete_layer_linework(
+            db, layer_id, batch_size=batch_size, skip_topology=skip_topology
         )
 
         db.run_query(
@@ -2,6 +2,7 @@
 Remove dangling edges from one or more layers.
 """
 
+from collections import defaultdict
 from pathlib import Path
 from typer import Argument, Context, Option, Typer
 from rich import print
@@ -29,16 +30,26 @@ def remove_dangling_edges(
     commit: bool = False,
     map_layer: int = Option(None, "--layer", "-l"),
     line_type: str = Option(None, "--type", "-t"),
+    bulk: bool = False,
+    drop_orphans: bool = False,
+    until_stable: bool = False,
 ):
     """Remove dangling edges from a layer.
 
     Args:
         map_layer: The ID of the map layer to remove dangling edges from.
         tolerance: The tolerance for removing dangling edges.
+        bulk: Remove all edges at once, rewriting each line only once.
+        drop_orphans: Also remove edges and nodes that no longer belong to any line.
+        until_stable: Keep removing the dangles exposed by each pass, until none are left.
+            Implies drop_orphans, since nodes only become dangling once the edges
+            removed from them are dropped from the topology.
     """
     db = setup_database(project)
 
-    sql = get_procedure("get-dangling-edges")
+    if until_stable and not drop_orphans:
+        print("--until-stable implies --drop-orphans")
+        drop_orphans = True
 
     filters = SQLFilters()
 
@@ -51,9 +62,8 @@ def remove_dangling_edges(
         filters.add("l.map_layer = :map_layer", {"map_layer": map_layer})
     if line_type is not None:
         filters.add("l.type = :type", {"type": line_type})
-    sql = sql.replace("{filters}", str(filters))
 
-    edges = db.run_query(sql, params=filters.params).all()
+    edges = get_dangling_edges(db, filters)
 
     if len(edges) == 0:
         print("No dangling edges found")
@@ -71,21 +81,108 @@ def remove_dangling_edges(
         print("No changes made")
         return
 
-    # Remove the dangling edges
-    # TODO: we could probably make this significantly more efficient by handling the topology
-    # change directly, rather than letting edges be recalculated from the linework.
+    pruned = defaultdict(float)
+    removed = set()
     with db.transaction():
-        for edge in edges:
-            print(
-                f"Removing edge {edge.edge_id} from line {edge.line_id} ({edge.length:.2g} m)"
+        while len(edges) > 0:
+            _remove(db, edges, bulk=bulk, drop_orphans=drop_orphans)
+            for edge in edges:
+                pruned[edge.layer] += edge.length
+                removed.add((edge.edge_id, edge.line_id))
+            if not until_stable:
+                break
+
+            # Removing an edge can only expose new dangles at its own nodes
+            nodes = {
+                node for edge in edges for node in (edge.start_node, edge.end_node)
+            }
+            worklist = filters.copy()
+            worklist.add(
+                "(e.start_node = ANY(:nodes) OR e.end_node = ANY(:nodes))",
+                {"nodes": sorted(nodes)},
             )
+            edges = [
+                edge
+                for edge in get_dangling_edges(db, worklist)
+                if (edge.edge_id, edge.line_id) not in removed
+            ]
+            if len(edges) > 0:
+                print(f"Found {len(edges)} newly dangling edges")
+
+    for layer, length in sorted(pruned.items()):
+        print(f"Layer {layer}: pruned {length:.2g} m of dangling edges")
+
+
+def get_dangling_edges(db, filters: "SQLFilters"):
+    sql = get_procedure("get-dangling-edges")
+    sql = sql.replace("{filters}", str(filters))
+    return db.run_query(sql, params=filters.params).all()
+
+
+def _remove(db, edges, *, bulk: bool = False, drop_orphans: bool = False):
+    if bulk:
+        remove_edges(db, edges)
+    else:
+        remove_edges_individually(db, edges)
+
+    if drop_orphans:
+        remove_orphaned_edges(db, [edge.edge_id for edge in edges])
+
+
+def remove_edges_individually(db, edges):
+    """Remove dangling edges from their lines one at a time"""
+    for edge in edges:
+        print(
+            f"Removing edge {edge.edge_id} from line {edge.line_id} ({edge.length:.2g} m)"
+        )
+        db.run_query(
+            get_procedure("remove-edge-from-line"),
+            params={
+                "edge_id": edge.edge_id,
+                "line_id": edge.line_id,
+            },
+        )
+
+
+def remove_edges(db, edges):
+    """Remove edges from their lines in bulk.
+
+    Edges are removed from the topology relations directly, so that each line's
+    geometry is recomputed only once no matter how many of its edges are removed.
+    """
+    edge_ids = [edge.edge_id for edge in edges]
+    line_ids = [edge.line_id for edge in edges]
+
+    lines = db.run_query(
+        get_procedure("remove-edges-from-lines"),
+        params={"edge_ids": edge_ids, "line_ids": line_ids},
+    ).scalars()
+    lines = sorted(set(lines))
+    db.run_query(
+        get_procedure("update-line-geometries"),
+        params={"line_ids": lines},
+    )
+    print(f"Removed {len(edges)} edges from {len(lines)} lines")
+
+
+def remove_orphaned_edges(db, edge_ids: list[int]):
+    """Remove edges that no longer belong to any line, and the nodes they leave isolated"""
+    removed = db.run_query(
+        get_procedure("remove-orphaned-edges"),
+        params={"edge_ids": edge_ids},
+    ).all()
+    nodes = {node for edge in removed for node in (edge.start_node, edge.end_node)}
+    n_nodes = 0
+    if len(nodes) > 0:
+        n_nodes = len(
             db.run_query(
-                get_procedure("remove-edge-from-line"),
-                params={
-                    "edge_id": edge.edge_id,
-                    "line_id": edge.line_id,
-                },
-            )
+                get_procedure("remove-isolated-nodes"),
+                params={"node_ids": sorted(nodes)},
+            ).all()
+        )
+    print(
+        f"Dropped {len(removed)} orphaned edges and {n_nodes} nodes from the topology"
+    )
 
 
 class SQLFilters:
@@ -101,6 +198,13 @@ class SQLFilters:
         if params is not None:
             self.params.update(params)
 
+    def copy(self):
+        """Copy the stack, so that filters can be added without affecting it."""
+        other = SQLFilters()
+        other.filters = list(self.filters)
+        other.params = dict(self.params)
+        return other
+
     def __str__(self):
         _filters = self.filters
         if len(_filters) == 0:
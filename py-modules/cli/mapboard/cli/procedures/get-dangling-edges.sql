@@ -2,7 +2,9 @@ SELECT
   e.edge_id,
   l.id line_id,
   l.map_layer layer,
-  ST_Length(e.geom) length
+  ST_Length(e.geom) length,
+  e.start_node,
+  e.end_node
 FROM {topo_schema}.edge_data e
 JOIN {topo_schema}.node_multiplicity snm
   ON e.start_node = snm.node_id
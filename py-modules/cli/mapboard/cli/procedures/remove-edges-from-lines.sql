@@ -0,0 +1,17 @@
+/** Remove many edges from their linework topogeometries at once.
+
+  Pairs of edges and lines are passed as parallel arrays. This edits the
+  topology relation table directly, which is what TopoGeom_remElement does
+  for a single element.
+ */
+DELETE FROM {topo_schema}.relation r
+USING
+  {data_schema}.linework l,
+  unnest(cast(:edge_ids AS integer[]), cast(:line_ids AS integer[])) AS d(edge_id, line_id)
+WHERE l.id = d.line_id
+  AND l.topo IS NOT NULL
+  AND r.topogeo_id = id(l.topo)
+  AND r.layer_id = layer_id(l.topo)
+  AND r.element_type = 2
+  AND r.element_id = d.edge_id
+RETURNING l.id
@@ -0,0 +1,21 @@
+/** Remove nodes that are no longer connected to any edge */
+WITH topo AS (
+  SELECT n.nspname AS name
+  FROM pg_class c
+  JOIN pg_namespace n
+    ON n.oid = c.relnamespace
+  WHERE c.oid = '{topo_schema}.edge_data'::regclass
+)
+SELECT topology.ST_RemIsoNode(topo.name, n.node_id)
+FROM {topo_schema}.node n, topo
+WHERE n.node_id = ANY(:node_ids)
+  AND NOT EXISTS (
+    SELECT 1 FROM {topo_schema}.edge_data e
+    WHERE e.start_node = n.node_id
+       OR e.end_node = n.node_id
+  )
+  AND NOT EXISTS (
+    SELECT 1 FROM {topo_schema}.relation r
+    WHERE r.element_type = 1
+      AND r.element_id = n.node_id
+  )
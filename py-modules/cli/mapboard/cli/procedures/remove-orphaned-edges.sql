@@ -0,0 +1,22 @@
+/** Remove edges that no longer belong to any topogeometry.
+
+  Returns the end nodes of the removed edges, which may now be isolated.
+ */
+WITH topo AS (
+  SELECT n.nspname AS name
+  FROM pg_class c
+  JOIN pg_namespace n
+    ON n.oid = c.relnamespace
+  WHERE c.oid = '{topo_schema}.edge_data'::regclass
+)
+SELECT
+  topology.ST_RemEdgeModFace(topo.name, e.edge_id) face,
+  e.start_node,
+  e.end_node
+FROM {topo_schema}.edge_data e, topo
+WHERE e.edge_id = ANY(:edge_ids)
+  AND NOT EXISTS (
+    SELECT 1 FROM {topo_schema}.relation r
+    WHERE r.element_type = 2
+      AND r.element_id = e.edge_id
+  )
@@ -0,0 +1,6 @@
+/** Recompute linework geometries from their topogeometries */
+UPDATE {data_schema}.linework l
+SET geometry = l.topo::geometry,
+    geometry_hash = {topo_schema}.hash_geometry(l.topo::geometry)
+WHERE l.id = ANY(:line_ids)
+  AND l.topo IS NOT NULL
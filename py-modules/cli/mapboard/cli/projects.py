@@ -17,7 +17,7 @@ from mapboard.core.settings import POSTGRES_IMAGE, connection_string, core_db
 
 from .database import setup_database
 from .fixtures import apply_fixtures
-from .mobile_export import export_database
+from .mobile_export import apply_changeset, export_database
 
 app = Typer(name="projects", no_args_is_help=True)
 
@@ -119,6 +119,7 @@ def drop(project: str, apply: bool = False):
 
 
 app.command(name="export")(export_database)
+app.command(name="apply-changeset")(apply_changeset)
 
 
 @app.command(name="copy")
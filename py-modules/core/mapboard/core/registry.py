@@ -0,0 +1,157 @@
+"""
+A bounded cache of project parameters and database clients.
+
+Project lookups hit the core database, and long-running workers would
+otherwise hold on to clients for dropped or re-parameterized projects
+forever. Entries expire after a fixed time, the least recently used
+entries are evicted once the cache is full, and the whole cache can be
+invalidated when the `projects` table changes.
+"""
+
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from typing import Callable, Hashable, Optional
+
+from mapboard.topology_manager.database import Database
+from sqlalchemy import Engine, create_engine
+
+from .settings import connection_string, core_db
+
+_project_columns = "database, data_schema, topo_schema, srid, tolerance"
+
+
+class LRUCache:
+    """A least-recently-used cache whose entries expire after `ttl` seconds"""
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: Optional[float] = 300,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default=None):
+        item = self._items.get(key, None)
+        if item is None:
+            return default
+        value, expires = item
+        if expires is not None and expires <= self.clock():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value):
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+        self._items[key] = (value, expires)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ProjectRegistry:
+    """Cached access to project parameters and per-project database clients.
+
+    Engines are pooled per database and shared by every project in it, so
+    evicting a project only drops its lightweight client.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = 300):
+        self.params = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.clients = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.engines: dict[str, Engine] = {}
+        self._lock = RLock()
+
+    def project_params(self, project: str) -> dict:
+        """Get the database connection parameters for a project, by slug"""
+        return self._get_params(
+            ("slug", project),
+            f"SELECT {_project_columns} FROM projects WHERE slug = :slug",
+            dict(slug=project),
+        )
+
+    def schema_params(self, database: str, data_schema: str) -> dict:
+        """Get the connection parameters for the project using a data schema"""
+        return self._get_params(
+            ("schema", database, data_schema),
+            f"SELECT {_project_columns} FROM projects WHERE database = :database AND data_schema = :data_schema",
+            dict(database=database, data_schema=data_schema),
+        )
+
+    def _get_params(self, key: Hashable, sql: str, query_params: dict) -> dict:
+        with self._lock:
+            params = self.params.get(key)
+            if params is None:
+                res = core_db.run_query(sql, query_params).one()
+                params = dict(
+                    database=res.database,
+                    data_schema=res.data_schema,
+                    topo_schema=res.topo_schema,
+                    srid=res.srid,
+                    tolerance=res.tolerance,
+                )
+                self.params.set(key, params)
+            # Callers are free to modify the returned parameters
+            return dict(params)
+
+    def engine(self, database: str, pool_size: int = 5) -> Engine:
+        """Get a pooled engine shared by all projects in a database"""
+        with self._lock:
+            engine = self.engines.get(database, None)
+            if engine is None:
+                # One extra connection can be held open for LISTEN
+                engine = create_engine(
+                    connection_string(database),
+                    pool_size=pool_size + 1,
+                    pool_pre_ping=True,
+                )
+                self.engines[database] = engine
+            return engine
+
+    def setup_database(self, project: str) -> Database:
+        """Create a new client for a project on the shared engine for its database"""
+        params = self.project_params(project)
+        db = Database(self.engine(params["database"]))
+        db.set_params(env={}, **params)
+        return db
+
+    def client(self, database: str, data_schema: str) -> Database:
+        """Get a cached, long-lived client for the project using a data schema"""
+        key = (database, data_schema)
+        with self._lock:
+            db = self.clients.get(key)
+            if db is None:
+                params = self.schema_params(database, data_schema)
+                db = Database(self.engine(database))
+                db.set_params(env={}, **params)
+                self.clients.set(key, db)
+            return db
+
+    def invalidate(self):
+        """Forget cached projects after a change to the projects table.
+
+        Cached entries are cheap to rebuild, so everything is dropped rather
+        than tracking which keys refer to the changed project.
+        """
+        with self._lock:
+            self.params.clear()
+            self.clients.clear()
+
+
+registry = ProjectRegistry()
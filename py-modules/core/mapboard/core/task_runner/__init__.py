@@ -3,8 +3,13 @@ A Celery-based interface for running tasks. Can be accessed either from
 the command line or via an API.
 """
 
+from hashlib import sha256
+from json import dumps
 from os import environ
+from uuid import uuid4
+
 from celery import Celery
+from celery.result import AsyncResult
 from redis import Redis
 
 
@@ -29,3 +34,30 @@ def _get_broker_url(broker_url=None):
     if broker_url is None:
         raise RuntimeError("No task broker defined")
     return broker_url
+
+
+def idempotency_key(task_name: str, kwargs: dict) -> str:
+    # A cost estimate only picks a lane, so it doesn't make a submission different
+    kwargs = {k: v for k, v in kwargs.items() if k != "cost"}
+    payload = dumps(dict(task=task_name, kwargs=kwargs), sort_keys=True, default=str)
+    return "mapboard:task-key:" + sha256(payload.encode()).hexdigest()
+
+
+def submit_once(task, queue: Redis, ttl: int = 24 * 60 * 60, **kwargs) -> AsyncResult:
+    """Submit a task, unless an identical submission is already in flight.
+
+    Identical submissions (same task and arguments) return the result handle of
+    the task that is already queued or running. The key is cleared when the task
+    finishes, or after `ttl` seconds.
+    """
+    key = idempotency_key(task.name, kwargs)
+    task_id = str(uuid4())
+    if not queue.set(key, task_id, nx=True, ex=ttl):
+        existing = queue.get(key)
+        if existing is not None:
+            return AsyncResult(existing.decode(), app=task.app)
+        # The key expired in the meantime
+        queue.set(key, task_id, ex=ttl)
+    return task.apply_async(
+        kwargs=kwargs, task_id=task_id, headers=dict(idempotency_key=key)
+    )
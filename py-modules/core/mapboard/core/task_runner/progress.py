@@ -0,0 +1,181 @@
+"""
+Progress reporting for long-running jobs.
+
+Commands report progress through `get_progress()`, which behaves like a
+`rich.progress.Progress` bar. When a command runs as a task, progress
+events are instead published to a Redis channel for the task, where the
+CLI or API can follow them without polling. Pub/sub doesn't keep messages,
+so the latest event of each step is also stored under a key for the task,
+for subscribers that arrive late.
+"""
+
+from contextvars import ContextVar
+from json import dumps, loads
+from time import monotonic
+from typing import Iterator, Optional
+
+from redis import Redis
+
+current_progress = ContextVar("current_progress", default=None)
+
+
+# Seconds to keep the last progress state of a task
+state_ttl = 24 * 60 * 60
+
+
+def progress_channel(task_id: str) -> str:
+    return f"mapboard:progress:{task_id}"
+
+
+def progress_state_key(task_id: str) -> str:
+    return f"mapboard:progress-state:{task_id}"
+
+
+class ProgressPublisher:
+    """Publishes progress events to a Redis channel.
+
+    Implements the subset of the `rich.progress.Progress` interface used
+    by Mapboard commands. Events for each step are throttled to one every
+    `min_interval` seconds, except for the final one.
+    """
+
+    def __init__(self, queue: Redis, task_id: str, min_interval: float = 0.5):
+        self.queue = queue
+        self.channel = progress_channel(task_id)
+        self.state_key = progress_state_key(task_id)
+        self.min_interval = min_interval
+        self.tasks: dict[int, dict] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for task_id in self.tasks:
+            self._publish(task_id, force=True)
+
+    def add_task(
+        self,
+        description: str,
+        total: Optional[float] = None,
+        completed: float = 0,
+        **kwargs,
+    ):
+        task_id = len(self.tasks)
+        self.tasks[task_id] = dict(
+            description=description,
+            total=total,
+            completed=completed,
+            started=monotonic(),
+            last_published=None,
+        )
+        self._publish(task_id, force=True)
+        return task_id
+
+    def update(
+        self,
+        task_id: int,
+        *,
+        advance: Optional[float] = None,
+        completed: Optional[float] = None,
+        total: Optional[float] = None,
+        **kwargs,
+    ):
+        task = self.tasks[task_id]
+        if total is not None:
+            task["total"] = total
+        if completed is not None:
+            task["completed"] = completed
+        if advance is not None:
+            task["completed"] += advance
+        self._publish(task_id)
+
+    def advance(self, task_id: int, advance: float = 1):
+        self.update(task_id, advance=advance)
+
+    def _publish(self, task_id: int, force: bool = False):
+        task = self.tasks[task_id]
+        now = monotonic()
+        total = task["total"]
+        finished = total is not None and task["completed"] >= total
+        last = task["last_published"]
+        if not (force or finished) and last is not None:
+            if now - last < self.min_interval:
+                return
+        task["last_published"] = now
+
+        elapsed = now - task["started"]
+        rate = task["completed"] / elapsed if elapsed > 0 else None
+        eta = None
+        if rate and total is not None:
+            eta = max(total - task["completed"], 0) / rate
+
+        event = dict(
+            step=task_id,
+            description=task["description"],
+            completed=task["completed"],
+            total=total,
+            rate=rate,
+            eta=eta,
+        )
+        self._send(str(task_id), event)
+
+    def finish(self, status: str = "SUCCESS", error: Optional[str] = None):
+        """Tell subscribers that no more events will follow"""
+        self._send("done", dict(done=True, status=status, error=error))
+
+    def _send(self, field: str, event: dict):
+        message = dumps(event)
+        pipeline = self.queue.pipeline()
+        pipeline.hset(self.state_key, field, message)
+        pipeline.expire(self.state_key, state_ttl)
+        pipeline.publish(self.channel, message)
+        pipeline.execute()
+
+
+def get_progress():
+    """A progress display for the current context: a Redis publisher when
+    running as a task, or a console progress bar otherwise."""
+    publisher = current_progress.get()
+    if publisher is not None:
+        return publisher
+
+    from rich.progress import Progress
+
+    return Progress()
+
+
+def subscribe_progress(
+    queue: Redis, task_id: str, timeout: Optional[float] = None
+) -> Iterator[dict]:
+    """Follow the progress events of a task until it finishes.
+
+    Starts with the latest stored event of each step, so that subscribing to
+    a task that is already running or finished doesn't wait forever. Raises
+    TimeoutError if no event arrives for `timeout` seconds.
+    """
+    pubsub = queue.pubsub()
+    pubsub.subscribe(progress_channel(task_id))
+    try:
+        # Read the stored state only once subscribed, so that no event is missed
+        state = queue.hgetall(progress_state_key(task_id))
+        done = state.pop(b"done", None)
+        for _, message in sorted(state.items(), key=lambda item: int(item[0])):
+            yield loads(message)
+        if done is not None:
+            yield loads(done)
+            return
+
+        last_event = monotonic()
+        while True:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                if timeout is not None and monotonic() - last_event > timeout:
+                    raise TimeoutError(f"No progress from task {task_id}")
+                continue
+            last_event = monotonic()
+            event = loads(message["data"])
+            yield event
+            if event.get("done", False):
+                return
+    finally:
+        pubsub.close()
@@ -1 +1 @@
-from .topology import watch_topology, send_event
+from .topology import watch_topology, watch_all_topology, send_event
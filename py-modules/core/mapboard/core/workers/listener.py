@@ -0,0 +1,155 @@
+"""
+A LISTEN connection that survives dropped connections.
+
+The connection is checked with a heartbeat query, and re-established
+with exponential backoff if it fails. Notifications sent while the
+connection was down are lost, so callers get a hook to catch up after
+each reconnect. TCP keepalives make the driver give up on a dead peer
+within about a minute, instead of after the kernel's retransmission
+timeout.
+"""
+
+import asyncio
+from json import loads
+from typing import Awaitable, Callable, Optional
+
+import psycopg2
+from psycopg2 import Error as DriverError
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import Engine
+from sqlalchemy.exc import DBAPIError
+
+# libpq settings for listening connections, which are idle most of the time
+keepalive_params = dict(
+    keepalives=1,
+    keepalives_idle=30,
+    keepalives_interval=10,
+    keepalives_count=3,
+    # Milliseconds that sent data can remain unacknowledged
+    tcp_user_timeout=60000,
+)
+
+
+async def listen_forever(
+    engine: Engine,
+    channel: str,
+    on_notify: Callable[[dict], None],
+    *,
+    on_reconnect: Optional[Callable[[], Awaitable[None]]] = None,
+    heartbeat: float = 30.0,
+    max_backoff: float = 60.0,
+):
+    """Listen on a channel, calling `on_notify` with each JSON payload"""
+    loop = asyncio.get_running_loop()
+    backoff = 1.0
+    connected_before = False
+    name = f"{engine.url.database}/{channel}"
+
+    while True:
+        try:
+            conn = raw_connection(engine)
+            conn.cursor().execute(f"LISTEN {channel};")
+        except (DBAPIError, DriverError) as err:
+            print(f"Could not listen on {name}, retrying in {backoff:.0f}s: {err}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+            continue
+
+        backoff = 1.0
+        lost = asyncio.Event()
+
+        def handle_readable():
+            try:
+                conn.poll()
+            except DriverError:
+                lost.set()
+                return
+            _dispatch_notifies(conn, on_notify)
+
+        loop.add_reader(conn, handle_readable)
+        print(f"Listening on {name}")
+
+        # We are already listening, so nothing sent from here on will be missed
+        catch_up = connected_before and on_reconnect is not None
+        connected_before = True
+        if catch_up:
+            catch_up = not await _catch_up(on_reconnect, name)
+
+        while not lost.is_set():
+            try:
+                await asyncio.wait_for(lost.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                # The heartbeat query blocks, so it runs off the event loop, which
+                # mustn't poll the connection meanwhile
+                loop.remove_reader(conn)
+                if not await _check_alive(loop, conn, heartbeat):
+                    lost.set()
+                    continue
+                loop.add_reader(conn, handle_readable)
+                # Notifications may have been consumed by the heartbeat query
+                _dispatch_notifies(conn, on_notify)
+                if catch_up:
+                    catch_up = not await _catch_up(on_reconnect, name)
+
+        print(f"Lost connection on {name}, reconnecting")
+        loop.remove_reader(conn)
+        # Closing waits for any query still running on the connection
+        loop.run_in_executor(None, _discard, conn)
+
+
+async def _check_alive(loop, conn, timeout: float) -> bool:
+    """Run the heartbeat query, treating a query that hangs as a lost connection"""
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(None, _is_alive, conn), timeout
+        )
+    except asyncio.TimeoutError:
+        return False
+
+
+async def _catch_up(on_reconnect: Callable[[], Awaitable[None]], name: str) -> bool:
+    """Run the reconnect hook, returning False if it failed.
+
+    Failures are logged rather than raised, so that the listener keeps running
+    and retries at the next heartbeat.
+    """
+    try:
+        await on_reconnect()
+        return True
+    except Exception as err:
+        print(f"Could not catch up on {name} after reconnecting, will retry: {err}")
+        return False
+
+
+def raw_connection(engine: Engine):
+    """A dedicated autocommit connection to an engine's database.
+
+    It is opened outside of the engine's pool, so that reconnects can't
+    exhaust the pool, and with TCP keepalives.
+    """
+    url = engine.url
+    params = url.translate_connect_args(database="dbname", username="user")
+    conn = psycopg2.connect(**params, **url.query, **keepalive_params)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+def _dispatch_notifies(conn, on_notify: Callable[[dict], None]):
+    for notify in conn.notifies:
+        on_notify(loads(notify.payload))
+    conn.notifies.clear()
+
+
+def _is_alive(conn) -> bool:
+    try:
+        conn.cursor().execute("SELECT 1")
+        return True
+    except DriverError:
+        return False
+
+
+def _discard(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
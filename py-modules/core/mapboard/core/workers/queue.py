@@ -0,0 +1,293 @@
+"""
+A durable queue of pending topology updates, stored in the core database.
+
+Pending work survives restarts of the watcher, and several watcher
+replicas can share the same queue: an update is only run by the worker
+that manages to claim its row. Topology tasks run by the task runner
+claim their updates in the same way, so a task and a watcher never
+update the same topology at once.
+"""
+
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from datetime import datetime
+from os import getpid
+from socket import gethostname
+from threading import Event, RLock, Thread
+from typing import Iterable, Optional
+
+from macrostrat.database import Database
+
+from mapboard.core.settings import core_db
+
+
+class TopologyQueue:
+    """Pending topology updates in the `mapboard.topology_queue` table.
+
+    Args:
+        claim_timeout: seconds after which a claim that isn't renewed is
+            considered abandoned (e.g. because its worker died) and can be
+            taken by another worker
+        max_attempts: failed updates are not retried automatically more than
+            this many times, until new edits arrive for the schema
+    """
+
+    def __init__(
+        self,
+        db: Database = core_db,
+        claim_timeout: float = 300,
+        max_attempts: int = 5,
+    ):
+        self.db = db
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.worker_id = f"{gethostname()}:{getpid()}"
+
+    def enqueue(self, database: str, data_schema: str):
+        """Record that a schema needs a topology update"""
+        self.enqueue_many([(database, data_schema)])
+
+    def enqueue_many(self, keys: Iterable[tuple[str, str]]):
+        """Record that several schemas need topology updates, in one statement"""
+        keys = list(keys)
+        if len(keys) == 0:
+            return
+        self._run(
+            """
+            INSERT INTO mapboard.topology_queue (database, data_schema)
+            SELECT * FROM unnest(cast(:databases AS text[]), cast(:schemas AS text[]))
+            ON CONFLICT (database, data_schema) DO UPDATE
+            SET updated_at = now(), attempts = 0
+            """,
+            dict(
+                databases=[database for database, _ in keys],
+                schemas=[data_schema for _, data_schema in keys],
+            ),
+        )
+
+    def claim(self, database: str, data_schema: str) -> Optional[datetime]:
+        """Claim a pending update, returning the claim time.
+
+        Returns None if another worker holds it, or if it is no longer queued
+        because another worker has already run it.
+        """
+        rows = self._run(
+            """
+            UPDATE mapboard.topology_queue q
+            SET claimed_at = now(),
+                claimed_by = :worker_id,
+                attempts = q.attempts + 1
+            FROM (
+              SELECT database, data_schema
+              FROM mapboard.topology_queue
+              WHERE database = :database
+                AND data_schema = :data_schema
+                AND (claimed_at IS NULL OR claimed_at < now() - make_interval(secs => :timeout))
+              FOR UPDATE SKIP LOCKED
+            ) c
+            WHERE q.database = c.database
+              AND q.data_schema = c.data_schema
+            RETURNING q.claimed_at
+            """,
+            dict(
+                database=database,
+                data_schema=data_schema,
+                worker_id=self.worker_id,
+                timeout=self.claim_timeout,
+            ),
+        )
+        if len(rows) == 0:
+            return None
+        return rows[0].claimed_at
+
+    def renew(self, database: str, data_schema: str) -> bool:
+        """Extend this worker's claim on an update, returning False if it was lost"""
+        rows = self._run(
+            """
+            UPDATE mapboard.topology_queue
+            SET claimed_at = now()
+            WHERE database = :database
+              AND data_schema = :data_schema
+              AND claimed_by = :worker_id
+            RETURNING claimed_at
+            """,
+            dict(database=database, data_schema=data_schema, worker_id=self.worker_id),
+        )
+        return len(rows) > 0
+
+    @contextmanager
+    def hold(self, database: str, data_schema: str):
+        """Claim an update for the duration of the block.
+
+        Yields the claim time, or None if the update can't be claimed. While
+        the block runs, the claim is renewed in a background thread, however
+        long the update takes. The update is completed if the block succeeds,
+        and released to be retried if it fails.
+        """
+        claimed_at = self.claim(database, data_schema)
+        if claimed_at is None:
+            yield None
+            return
+
+        stop = Event()
+        renewal = Thread(
+            target=self._keep_claim, args=(database, data_schema, stop), daemon=True
+        )
+        renewal.start()
+        succeeded = False
+        try:
+            yield claimed_at
+            succeeded = True
+        finally:
+            stop.set()
+            renewal.join()
+            try:
+                if succeeded:
+                    self.complete(database, data_schema, claimed_at)
+                else:
+                    self.release(database, data_schema)
+            except Exception as err:
+                print(f"Could not update the topology queue for {data_schema}: {err}")
+
+    def _keep_claim(self, database: str, data_schema: str, stop: Event):
+        """Renew a claim every third of the claim timeout until stopped"""
+        try:
+            while not stop.wait(self.claim_timeout / 3):
+                try:
+                    if not self.renew(database, data_schema):
+                        print(f"Lost the claim on the update for {data_schema}")
+                        return
+                except Exception as err:
+                    print(f"Could not renew the claim for {data_schema}: {err}")
+        finally:
+            self.db.session.remove()
+
+    def complete(self, database: str, data_schema: str, claimed_at: datetime):
+        """Remove a finished update, unless new edits arrived after it was claimed"""
+        params = dict(database=database, data_schema=data_schema, claimed_at=claimed_at)
+        self._run(
+            """
+            DELETE FROM mapboard.topology_queue
+            WHERE database = :database
+              AND data_schema = :data_schema
+              AND updated_at <= :claimed_at
+            """,
+            params,
+        )
+        self.release(database, data_schema)
+
+    def drop(self, database: str, data_schema: str):
+        """Remove an update that can't be run, e.g. for a project that no longer exists"""
+        self._run(
+            """
+            DELETE FROM mapboard.topology_queue
+            WHERE database = :database
+              AND data_schema = :data_schema
+            """,
+            dict(database=database, data_schema=data_schema),
+        )
+
+    def release(self, database: str, data_schema: str):
+        """Give up a claim so that the update can be retried"""
+        self._run(
+            """
+            UPDATE mapboard.topology_queue
+            SET claimed_at = NULL, claimed_by = NULL
+            WHERE database = :database
+              AND data_schema = :data_schema
+              AND claimed_by = :worker_id
+            """,
+            dict(database=database, data_schema=data_schema, worker_id=self.worker_id),
+        )
+
+    def pending(self, databases: Optional[list[str]] = None) -> list[tuple[str, str]]:
+        """Unclaimed (or abandoned) updates that can still be retried, oldest first"""
+        rows = self._run(
+            """
+            SELECT database, data_schema
+            FROM mapboard.topology_queue
+            WHERE (cast(:databases AS text[]) IS NULL OR database = ANY(:databases))
+              AND attempts < :max_attempts
+              AND (claimed_at IS NULL OR claimed_at < now() - make_interval(secs => :timeout))
+            ORDER BY enqueued_at
+            """,
+            dict(
+                databases=databases,
+                timeout=self.claim_timeout,
+                max_attempts=self.max_attempts,
+            ),
+        )
+        return [(row.database, row.data_schema) for row in rows]
+
+    def _run(self, sql: str, params: dict) -> list:
+        """Run a statement in its own transaction, returning any result rows"""
+        res = self.db.run_query(sql, params)
+        rows = res.all() if res.returns_rows else []
+        self.db.session.commit()
+        return rows
+
+
+class QueueWriter:
+    """Records pending updates in a topology queue without blocking the caller.
+
+    Keys are written in batches by an executor: keys added while a batch is
+    being written go into the next one. Keys that could not be written are
+    kept, and retried with the next batch.
+    """
+
+    def __init__(self, queue: TopologyQueue, executor: Executor):
+        self.queue = queue
+        self.executor = executor
+        self._lock = RLock()
+        self._unwritten: set[tuple[str, str]] = set()
+        self._batch: set[tuple[str, str]] = set()
+        self._writing: Optional[Future] = None
+
+    def add(self, key: tuple[str, str]):
+        with self._lock:
+            self._unwritten.add(key)
+            if self._writing is None:
+                self._start()
+
+    def flush(self, key: tuple[str, str]) -> bool:
+        """Wait until a key is written, returning False if it could not be"""
+        with self._lock:
+            writing = self._writing if key in self._batch else None
+        if writing is not None:
+            writing.result()
+        # Keys from a failed batch are back among the unwritten ones
+        with self._lock:
+            unwritten = key in self._unwritten
+            self._unwritten.discard(key)
+        if unwritten:
+            return self._write({key})
+        return True
+
+    def retry(self):
+        """Write keys left over from failed batches"""
+        with self._lock:
+            if self._writing is None and len(self._unwritten) > 0:
+                self._start()
+
+    def _start(self):
+        self._batch = self._unwritten
+        self._unwritten = set()
+        self._writing = self.executor.submit(self._write, self._batch)
+        self._writing.add_done_callback(self._done)
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._writing = None
+            self._batch = set()
+            if future.result() and len(self._unwritten) > 0:
+                self._start()
+
+    def _write(self, keys: set[tuple[str, str]]) -> bool:
+        try:
+            self.queue.enqueue_many(keys)
+            return True
+        except Exception as err:
+            print(f"Could not record {len(keys)} pending updates: {err}")
+            with self._lock:
+                self._unwritten |= keys
+            return False
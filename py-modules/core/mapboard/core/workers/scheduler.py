@@ -0,0 +1,170 @@
+"""
+Scheduling for topology updates.
+
+Change notifications tend to arrive in bursts while a user is editing,
+so events for each schema are coalesced and only released once the
+schema has been quiet for a short period (or has waited too long).
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Callable, Hashable, Iterable, Optional
+
+# Events that don't say what changed, and always force a full update
+full_update_events = {"catch-up", "restored"}
+
+
+@dataclass
+class DirtyRegion:
+    """Features changed since the last topology update of a schema.
+
+    Built from `feature-change` notifications. Events that force a full update
+    (such as `catch-up`), and feature changes that don't list their ids, mark
+    the region as incomplete. Other events only name the schema: the topology
+    manager sends one alongside each feature change, so they add nothing once
+    a feature change has been seen, and otherwise force a full update.
+    """
+
+    linework: set[int] = field(default_factory=set)
+    polygon: set[int] = field(default_factory=set)
+    complete: bool = True
+    deleted: bool = False
+    attributes: bool = False
+    # Whether any event described the features it changed
+    described: bool = False
+
+    def add_event(self, payload: dict):
+        _type = payload.get("type")
+        if _type in full_update_events:
+            self.complete = False
+        if _type != "feature-change":
+            return
+
+        table = payload.get("table")
+        ids = payload.get("ids")
+        if table not in ("linework", "polygon") or ids is None:
+            self.complete = False
+        else:
+            getattr(self, table).update(ids)
+            self.described = True
+
+        if payload.get("op") == "DELETE":
+            self.deleted = True
+        if payload.get("attributes", False):
+            self.attributes = True
+
+    def merge(self, other: "DirtyRegion"):
+        self.linework |= other.linework
+        self.polygon |= other.polygon
+        self.complete = self.complete and other.complete
+        self.deleted = self.deleted or other.deleted
+        self.attributes = self.attributes or other.attributes
+        self.described = self.described or other.described
+
+    @property
+    def linework_only(self) -> bool:
+        """Whether the only changes were to the geometry of existing lines"""
+        return (
+            self.complete
+            and self.described
+            and not self.deleted
+            and not self.attributes
+            and len(self.polygon) == 0
+        )
+
+
+@dataclass
+class PendingUpdate:
+    """Change events accumulated for a single data schema"""
+
+    first_event: float
+    last_event: float
+    n_events: int = 1
+    region: DirtyRegion = field(default_factory=DirtyRegion)
+
+
+class TopologyScheduler:
+    """Coalesce change events into debounced topology updates.
+
+    Pending updates are keyed by `(database, data_schema)`.
+
+    Args:
+        quiet_period: seconds without new events before a schema is updated
+        max_delay: maximum seconds a schema can wait after its oldest pending event
+    """
+
+    def __init__(
+        self,
+        quiet_period: float = 2.0,
+        max_delay: float = 30.0,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.clock = clock
+        self.pending: dict[Hashable, PendingUpdate] = {}
+        self._wakeup = asyncio.Event()
+
+    def enqueue(self, key: Hashable, payload: Optional[dict] = None):
+        """Record a change event for a schema and wake the dispatcher"""
+        now = self.clock()
+        item = self.pending.get(key)
+        if item is None:
+            item = PendingUpdate(first_event=now, last_event=now)
+            self.pending[key] = item
+        else:
+            item.last_event = now
+            item.n_events += 1
+        item.region.add_event(payload or {})
+        self.wake()
+
+    def wake(self):
+        """Wake the dispatcher, e.g. when a worker becomes free"""
+        self._wakeup.set()
+
+    def due_time(self, item: PendingUpdate) -> float:
+        return min(
+            item.last_event + self.quiet_period, item.first_event + self.max_delay
+        )
+
+    def ready(self, exclude: Iterable[Hashable] = ()) -> list[Hashable]:
+        """Schemas that are due for an update, oldest pending event first"""
+        now = self.clock()
+        exclude = set(exclude)
+        due = [
+            (item.first_event, key)
+            for key, item in self.pending.items()
+            if key not in exclude and self.due_time(item) <= now
+        ]
+        return [key for _, key in sorted(due)]
+
+    def pop(self, key: Hashable) -> PendingUpdate:
+        return self.pending.pop(key)
+
+    def next_due(self, exclude: Iterable[Hashable] = ()) -> Optional[float]:
+        exclude = set(exclude)
+        times = [
+            self.due_time(item)
+            for key, item in self.pending.items()
+            if key not in exclude
+        ]
+        if len(times) == 0:
+            return None
+        return min(times)
+
+    async def wait(self, exclude: Iterable[Hashable] = (), until_due: bool = True):
+        """Wait for a new event, or until the next pending schema is due.
+
+        If `until_due` is false, only an explicit wakeup ends the wait.
+        """
+        timeout = None
+        if until_due:
+            next_due = self.next_due(exclude)
+            if next_due is not None:
+                timeout = max(next_due - self.clock(), 0)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
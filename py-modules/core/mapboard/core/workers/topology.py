@@ -3,141 +3,397 @@ Worker that continuously checks for new topology tasks and
 sends them to the broker for processing.
 """
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextvars import ContextVar
-from json import loads
 
 from mapboard.topology_manager.commands.update import _update
 from mapboard.topology_manager.database import Database
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from datetime import datetime
+from typing import Optional
 
+from mapboard.core.registry import registry
 from mapboard.core.settings import core_db, connection_string
 from json import dumps
 
+from .listener import listen_forever, raw_connection
+from .queue import QueueWriter, TopologyQueue
+from .scheduler import DirtyRegion, TopologyScheduler
+
 verbose = True
 
-update_in_progress = ContextVar("update_in_progress", default=False)
-needs_update = ContextVar("needs_update", default=set())
-clients = ContextVar("clients", default={})
-
-
-def project_params(data_schema: str):
-    res = core_db.run_query(
-        "SELECT database, data_schema, topo_schema, srid, tolerance FROM projects WHERE data_schema = :data_schema",
-        dict(data_schema=data_schema),
-    ).one()
-    return dict(
-        database=res.database,
-        data_schema=res.data_schema,
-        topo_schema=res.topo_schema,
-        srid=res.srid,
-        tolerance=res.tolerance,
-    )
+update_in_progress = ContextVar("update_in_progress", default=set())
+listeners = ContextVar("listeners", default={})
+work_queue = TopologyQueue()
+# Pending updates are recorded in the durable queue by a single background thread
+queue_writer = QueueWriter(
+    work_queue, ThreadPoolExecutor(max_workers=1, thread_name_prefix="topology-queue")
+)
 
 
 def get_client(database: str, data_schema: str) -> Database:
-    _clients = clients.get()
-    client = _clients.get(data_schema, None)
-    if client is not None:
-        return client
-
-    # Setup client
-    params = project_params(data_schema)
-    assert params["database"] == database
-    DATABASE_URL = connection_string(database)
-    db = Database(DATABASE_URL)
-    db.set_params(env={}, **params)
-
-    _clients[data_schema] = db
-    clients.set(_clients)
-
-    return db
+    return registry.client(database, data_schema)
 
 
-def watch_topology(database: str):
+def watch_topology(
+    database: str,
+    workers: int = 4,
+    quiet_period: float = 2.0,
+    max_delay: float = 30.0,
+):
     """Watch database(s) for topology changes.
 
     Unlike the core watcher in
     mapboard.topology_manager, this works across multiple projects,
-    if they share the same database.
+    if they share the same database. Updates for different projects
+    run concurrently in a pool of worker threads, with at most one
+    update in flight for each data schema.
+
+    Bursts of edits are coalesced: a schema is updated once it has seen
+    no new events for `quiet_period` seconds, or `max_delay` seconds after
+    its oldest pending event, whichever comes first.
+    """
+    _watch([database], workers, quiet_period, max_delay, poll_databases=[database])
+
+
+def watch_all_topology(
+    workers: int = 4,
+    quiet_period: float = 2.0,
+    max_delay: float = 30.0,
+    refresh_interval: float = 60.0,
+):
+    """Watch every project database for topology changes.
+
+    Listens on each distinct database in the projects table from a single
+    process, and checks for newly created projects every `refresh_interval`
+    seconds.
     """
-    DATABASE_URL = connection_string(database)
-    main_db = Database(DATABASE_URL)
+    _watch(
+        project_databases(),
+        workers,
+        quiet_period,
+        max_delay,
+        refresh_interval=refresh_interval,
+    )
+
+
+def project_databases() -> list[str]:
+    res = core_db.run_query("SELECT DISTINCT database FROM projects").scalars()
+    return sorted(res)
 
-    # Get a raw connection to listen for notifications
-    conn = _raw_connection(main_db)
 
-    print(f"Watching database {database} for topology changes...")
+def _watch(
+    databases: list[str],
+    workers: int,
+    quiet_period: float,
+    max_delay: float,
+    refresh_interval: float = None,
+    poll_databases: Optional[list[str]] = None,
+    poll_interval: float = 60.0,
+):
     loop = asyncio.get_event_loop()
 
-    loop.add_reader(conn, create_notify_handler(conn))
-    loop.create_task(update_topology_sequentially(database))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="topology")
+    scheduler = TopologyScheduler(quiet_period=quiet_period, max_delay=max_delay)
 
-    loop.run_forever()
+    for database in databases:
+        listen(loop, database, scheduler, pool_size=workers)
+    listen_for_project_changes(loop)
 
+    # Pick up work left over from previous runs, or abandoned by other workers
+    try:
+        restore_queued_updates(scheduler, work_queue.pending(poll_databases))
+    except Exception as err:
+        print(f"Could not check the topology queue, will retry: {err}")
+    loop.create_task(poll_queued_updates(scheduler, poll_databases, poll_interval))
 
-def create_notify_handler(conn):
-    cursor = conn.cursor()
-    cursor.execute("LISTEN events;")
+    loop.create_task(update_topology_concurrently(scheduler, executor, workers))
+    if refresh_interval is not None:
+        loop.create_task(
+            watch_for_new_databases(loop, scheduler, refresh_interval, workers)
+        )
+
+    loop.run_forever()
 
-    def handle_notify():
-        conn.poll()
-        for notify in conn.notifies:
-            json_payload = loads(notify.payload)
-            _type = json_payload.get("type", None)
-            if _type == "test":
-                print("Received test event", json_payload)
-                continue
 
-            schema = json_payload.get("schema")
+def listen(loop, database: str, scheduler: TopologyScheduler, pool_size: int = 5):
+    """Start listening for change events in a database"""
+    _listeners = listeners.get()
+    if database in _listeners:
+        return
+
+    def handle_event(payload: dict):
+        _type = payload.get("type", None)
+        if _type == "test":
+            print("Received test event", payload)
+            return
+        schema = payload.get("schema")
+        enqueue(scheduler, (database, schema), payload)
+
+    async def handle_reconnect():
+        # Edits made while disconnected never produced events, so look for them
+        schemas = await loop.run_in_executor(None, find_stale_schemas, database)
+        for schema in schemas:
+            print(f"Found changes in {schema} made while disconnected")
+            enqueue(scheduler, (database, schema), dict(type="catch-up"))
+
+    engine = registry.engine(database, pool_size=pool_size)
+    task = loop.create_task(
+        listen_forever(engine, "events", handle_event, on_reconnect=handle_reconnect)
+    )
 
-            status = needs_update.get()
-            status.add(schema)
-            needs_update.set(status)
-        conn.notifies.clear()
+    _listeners[database] = task
+    listeners.set(_listeners)
 
-    return handle_notify
 
+def enqueue(scheduler: TopologyScheduler, key: tuple[str, str], payload: dict):
+    """Record a pending update.
 
-async def update_topology_sequentially(database: str):
-    """Check for topology updates and run them sequentially"""
+    Events are coalesced in memory, and recorded in the durable queue in
+    batches off the event loop, so that other replicas and later runs can
+    see them while they are debounced or waiting for a free worker.
+    """
+    scheduler.enqueue(key, payload)
+    queue_writer.add(key)
+
+
+def restore_queued_updates(scheduler: TopologyScheduler, queued: list[tuple[str, str]]):
+    """Schedule unclaimed updates from the durable queue"""
+    in_progress = update_in_progress.get()
+    for key in queued:
+        if key in scheduler.pending or key in in_progress:
+            continue
+        print(f"Restoring queued update for {key[1]} in {key[0]}")
+        scheduler.enqueue(key, dict(type="restored"))
+
+
+async def poll_queued_updates(
+    scheduler: TopologyScheduler,
+    databases: Optional[list[str]],
+    poll_interval: float,
+):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(poll_interval)
+        # Updates that could not be recorded are picked up once they are
+        queue_writer.retry()
+        try:
+            queued = await loop.run_in_executor(None, work_queue.pending, databases)
+            restore_queued_updates(scheduler, queued)
+        except Exception as err:
+            print(f"Could not check the topology queue: {err}")
+
+
+def find_stale_schemas(database: str) -> list[str]:
+    """Find the projects in a database with lines the topology has not yet seen"""
+    schemas = core_db.run_query(
+        "SELECT data_schema FROM projects WHERE database = :database",
+        dict(database=database),
+    ).scalars()
+    stale = []
+    for data_schema in schemas:
+        db = get_client(database, data_schema)
+        if has_stale_linework(db):
+            stale.append(data_schema)
+        db.session.close()
+    return stale
+
+
+async def watch_for_new_databases(
+    loop, scheduler: TopologyScheduler, refresh_interval: float, pool_size: int
+):
+    """Periodically start listening on databases of newly created projects"""
     while True:
-        await _update_topology(database)
+        await asyncio.sleep(refresh_interval)
+        try:
+            databases = project_databases()
+        except Exception as err:
+            print(f"Could not check for new projects: {err}")
+            continue
+        for database in databases:
+            listen(loop, database, scheduler, pool_size=pool_size)
+
+
+def listen_for_project_changes(loop):
+    """Drop cached project parameters and clients when the projects table changes"""
+
+    def handle_change(payload: dict):
+        print("Projects changed, clearing cached project clients")
+        registry.invalidate()
+
+    async def handle_reconnect():
+        # Changes may have been missed while disconnected
+        registry.invalidate()
+
+    loop.create_task(
+        listen_forever(
+            core_db.engine, "projects", handle_change, on_reconnect=handle_reconnect
+        )
+    )
 
 
-def _raw_connection(database: Database):
-    conn = database.engine.connect()
-    conn = conn.connection
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    return conn
+async def update_topology_concurrently(
+    scheduler: TopologyScheduler,
+    executor: ThreadPoolExecutor,
+    workers: int,
+):
+    """Check for topology updates and hand them to a pool of workers"""
+    while True:
+        in_progress = update_in_progress.get()
+        has_capacity = len(in_progress) < workers
+        if has_capacity:
+            _start_updates(scheduler, executor, workers)
+        # Wake on new events, finished updates, or when the next schema is due
+        await scheduler.wait(exclude=in_progress, until_due=has_capacity)
+
+
+def _start_updates(
+    scheduler: TopologyScheduler,
+    executor: ThreadPoolExecutor,
+    workers: int,
+):
+    in_progress = update_in_progress.get()
+
+    # Only one update can run at a time for each schema; others wait for the next pass
+    ready = scheduler.ready(exclude=in_progress)
+    if len(ready) == 0:
+        return
+
+    print("Updating topology", ready)
+
+    loop = asyncio.get_running_loop()
+    for key in ready:
+        if len(in_progress) >= workers:
+            break
+        database, data_schema = key
+        pending = scheduler.pop(key)
+
+        # Clients are set up on the event loop thread, since they query the core database
+        try:
+            db = get_client(*key)
+        except Exception as err:
+            # e.g. the project was dropped; retrying won't help
+            print(f"Dropping update for {data_schema} in {database}: {err}")
+            loop.run_in_executor(None, _update_queue, work_queue.drop, key)
+            continue
+
+        in_progress.add(key)
+        print(
+            f"Updating topology for {data_schema} in {database} ({pending.n_events} events)"
+        )
+        task = loop.run_in_executor(executor, claim_and_update, db, key, pending.region)
+        task.add_done_callback(_create_done_handler(key, scheduler))
+
+
+def claim_and_update(db: Database, key: tuple[str, str], region: DirtyRegion) -> bool:
+    """Claim an update in the durable queue, then run it.
+
+    Runs in a worker thread, so that queue bookkeeping doesn't block the
+    event loop. Returns False if another worker holds the claim, or has
+    already run the update.
+    """
+    if not queue_writer.flush(key):
+        # Without a claim, the update could run alongside another worker's
+        raise RuntimeError("the update could not be recorded in the topology queue")
 
+    with work_queue.hold(*key) as claimed_at:
+        if claimed_at is None:
+            return False
+        run_update(db, region)
+    return True
 
-async def _update_topology(database):
-    status = needs_update.get()
 
-    if len(status) == 0 or update_in_progress.get():
-        await asyncio.sleep(1)
-        return
+def _update_queue(method, key: tuple[str, str], *args):
+    try:
+        method(*key, *args)
+    except Exception as err:
+        print(f"Could not update the topology queue for {key[1]}: {err}")
 
-    print("Updating topology", status)
 
-    update_in_progress.set(True)
-    next_schema = status.pop()
-    needs_update.set(status)
+def run_update(db: Database, region: DirtyRegion):
+    """Update the topology for a schema, unless none of its changes affect it.
 
-    print(f"Updating topology for {next_schema}")
-    # Do the update
-    db = get_client(database, next_schema)
-    print(f"Updating topology for {next_schema}", db)
+    The topology manager already limits its work to lines whose geometry hash
+    is stale, so here we only need to decide whether an update is needed at all.
+    """
+    if region.linework_only:
+        try:
+            stale = has_stale_linework(db, region.linework)
+        finally:
+            # Don't leave the worker thread's session idle in a transaction
+            db.session.close()
+        if not stale:
+            print("No geometry changes, skipping topology update")
+            return
     _update(db)
-    update_in_progress.set(False)
+
+
+# Topological lines that have changed since the topology last saw them
+_stale_linework = """
+SELECT 1 FROM {data_schema}.linework l
+JOIN {data_schema}.map_layer ml
+  ON ml.id = l.map_layer
+WHERE ml.topological
+  AND (cast(:ids AS integer[]) IS NULL OR l.id = ANY(:ids))
+  AND (
+    l.topo IS NULL
+    OR l.geometry_hash IS DISTINCT FROM {topo_schema}.hash_geometry(l.geometry)
+  )
+"""
+
+
+def has_stale_linework(db: Database, ids: Optional[set[int]] = None) -> bool:
+    """Whether any topological lines have changed since the topology last saw them.
+
+    If `ids` is given, only those lines are checked.
+    """
+    if ids is not None and len(ids) == 0:
+        return False
+    return db.run_query(
+        f"SELECT EXISTS ({_stale_linework})",
+        dict(ids=None if ids is None else list(ids)),
+    ).scalar()
+
+
+def count_stale_linework(db: Database, limit: Optional[int] = None) -> int:
+    """The number of topological lines that a topology update has to process.
+
+    Counting stops at `limit`, which is enough to tell a small update from a
+    large one without scanning the rest of the lines.
+    """
+    return db.run_query(
+        f"SELECT count(*) FROM ({_stale_linework} LIMIT :limit) stale",
+        dict(ids=None, limit=limit),
+    ).scalar()
+
+
+def _create_done_handler(key: tuple[str, str], scheduler: TopologyScheduler):
+    database, data_schema = key
+
+    def handle_done(task: asyncio.Future):
+        update_in_progress.get().discard(key)
+        # A worker is free, and events may have queued up for this schema
+        scheduler.wake()
+        err = task.exception()
+        if err is not None:
+            print(f"Topology update for {data_schema} failed: {err}")
+            return
+        if task.result() is False:
+            # Edits recorded after the other worker's claim keep the update queued,
+            # and it will be picked up from there
+            print(
+                f"Update for {data_schema} in {database} is claimed by another worker"
+            )
+            return
+        print(f"Finished updating topology for {data_schema}")
+
+    return handle_done
 
 
 def send_event(database: str):
     """Send an event to the database for testing purposes"""
     url = connection_string(database)
     db = Database(url)
-    conn = _raw_connection(db)
+    conn = raw_connection(db.engine)
     cursor = conn.cursor()
     test_event = dict(
         type="test",
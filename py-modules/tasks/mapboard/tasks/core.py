@@ -4,16 +4,54 @@ the command line or via an API.
 """
 
 from os import environ
-from celery import Celery
-from redis import Redis
+
+from celery import Task
+from celery.states import READY_STATES
+from kombu import Queue
+from mapboard.core.task_runner import get_celery_app, get_message_queue
+from mapboard.core.task_runner.progress import ProgressPublisher, current_progress
+
+from .lanes import default_lane, lanes, route_task
 
 TASK_BROKER = environ.get("TASK_BROKER")
 
 # Set up the Celery runner and message queue
 
-app = Celery(
-    "mapboard.task_runner",
-    broker=TASK_BROKER,
+app = get_celery_app(TASK_BROKER)
+
+queue = get_message_queue(TASK_BROKER)
+
+
+app.conf.update(
+    # Topology updates can run for a long time; only acknowledge them once they
+    # finish, so that tasks from a crashed worker are redelivered
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    task_queues=[Queue(name) for name in lanes],
+    task_default_queue=default_lane,
+    task_routes=(route_task,),
 )
 
-queue = Redis.from_url(TASK_BROKER)
+
+class ProgressTask(Task):
+    """A task that publishes progress events to a Redis channel named for its id,
+    and releases its idempotency key when it finishes."""
+
+    def __call__(self, *args, **kwargs):
+        publisher = ProgressPublisher(queue, self.request.id)
+        token = current_progress.set(publisher)
+        try:
+            return super().__call__(*args, **kwargs)
+        finally:
+            current_progress.reset(token)
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        if status not in READY_STATES:
+            # e.g. the task is being retried
+            return
+        error = None if einfo is None else str(retval)
+        ProgressPublisher(queue, task_id).finish(status, error)
+
+        key = self.request.get("idempotency_key")
+        if key is not None and queue.get(key) == task_id.encode():
+            queue.delete(key)
@@ -0,0 +1,80 @@
+"""
+Priority lanes for tasks.
+
+Interactive work (e.g. updating the topology after a user edits a line)
+must not wait behind multi-hour bulk jobs. Each lane is a separate queue,
+served by its own workers with their own concurrency and prefetch limits.
+Tasks declare a default lane, and interactive tasks that their caller
+declares to be expensive are moved to the bulk lane.
+"""
+
+from dataclasses import dataclass
+from os import environ
+from typing import Optional
+
+
+@dataclass
+class Lane:
+    name: str
+    concurrency: int
+    prefetch_multiplier: int = 1
+
+
+lanes = {
+    "interactive": Lane(
+        "interactive", concurrency=int(environ.get("INTERACTIVE_CONCURRENCY", 4))
+    ),
+    "bulk": Lane("bulk", concurrency=int(environ.get("BULK_CONCURRENCY", 2))),
+    "maintenance": Lane(
+        "maintenance", concurrency=int(environ.get("MAINTENANCE_CONCURRENCY", 1))
+    ),
+}
+
+default_lane = "interactive"
+
+# Interactive tasks touching more features than this are run in the bulk lane
+interactive_max_cost = int(environ.get("INTERACTIVE_MAX_COST", 5000))
+
+
+def estimate_cost(kwargs: dict) -> Optional[float]:
+    """The number of features a task will touch, if the caller gave it.
+
+    Callers that know the size of the change (e.g. the number of dirty
+    features) pass it as the `cost` keyword argument. Without it, a task stays
+    in its declared lane: the size of the whole project says little about the
+    size of an incremental update.
+    """
+    return kwargs.get("cost", None)
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """Route a task to its lane"""
+    # Celery passes None for arguments that weren't given, e.g. apply_async(args=...)
+    kwargs = kwargs or {}
+    lane = getattr(task, "lane", None) or default_lane
+    if lane == "interactive":
+        cost = estimate_cost(kwargs)
+        if cost is not None and cost > interactive_max_cost:
+            lane = "bulk"
+
+    return {"queue": lane}
+
+
+def run_worker(lane: str):
+    """Run a worker for a single lane, with that lane's limits"""
+    from .core import app
+
+    settings = lanes[lane]
+    app.worker_main(
+        [
+            "worker",
+            "--queues",
+            settings.name,
+            "--concurrency",
+            str(settings.concurrency),
+            "--prefetch-multiplier",
+            str(settings.prefetch_multiplier),
+            "--hostname",
+            f"{settings.name}@%h",
+        ]
+    )
@@ -0,0 +1,26 @@
+"""
+Locks that keep two workers from updating the same topology at once.
+
+Tasks claim their project's update in the durable topology queue, which the
+topology watcher uses too, so that a task never runs alongside the watcher.
+"""
+
+from contextlib import contextmanager
+
+from mapboard.core.workers.queue import TopologyQueue
+from mapboard.topology_manager.database import Database
+
+work_queue = TopologyQueue()
+
+
+@contextmanager
+def schema_lock(db: Database):
+    """Hold the claim on a project's topology update for the duration of the block.
+
+    Yields False if another worker holds the claim. The claim is renewed
+    while the block runs, and expires a few minutes after a worker crashes.
+    """
+    key = (db.engine.url.database, db.instance_params["data_schema_name"])
+    work_queue.enqueue(*key)
+    with work_queue.hold(*key) as claimed_at:
+        yield claimed_at is not None
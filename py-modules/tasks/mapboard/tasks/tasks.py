@@ -2,14 +2,105 @@
 Define tasks for the task runner.
 """
 
-from .core import app
+from celery.result import AsyncResult
+from mapboard.core.database import setup_database
+from mapboard.core.task_runner import get_message_queue, submit_once
+from mapboard.core.workers.topology import count_stale_linework
+from mapboard.topology_manager.commands.update import _update
 
-from mapboard.topology_manager import update_topology
+from .core import ProgressTask, app
+from .lanes import interactive_max_cost
+from .locks import schema_lock
 
+# Seconds to wait before retrying a task whose topology is locked by another worker
+lock_retry_delay = 10
+# Give up on a locked topology after about an hour
+lock_max_retries = 360
 
-@app.task
-def update_topology():
+
+@app.task(bind=True, max_retries=lock_max_retries, lane="interactive")
+def update_topology(self, project: str, cost: int = None):
+    """
+    Update the topology of the map. `cost` is an optional estimate of the
+    number of changed features, used to pick a lane.
+    """
+    db = setup_database(project)
+    with schema_lock(db) as acquired:
+        if not acquired:
+            raise self.retry(countdown=lock_retry_delay)
+        _update(db)
+
+
+def submit_topology_update(project: str) -> AsyncResult:
+    """Submit a topology update for a project, unless one is already queued.
+
+    The update's cost is the number of lines whose topology is stale, so that
+    large updates (e.g. after an import) are routed to the bulk lane.
+    """
+    db = setup_database(project)
+    try:
+        cost = count_stale_linework(db, limit=interactive_max_cost + 1)
+    finally:
+        db.session.close()
+    return submit_once(update_topology, get_message_queue(), project=project, cost=cost)
+
+
+@app.task(bind=True, max_retries=lock_max_retries, lane="maintenance")
+def update_composite_layers(self, project: str):
+    """
+    Update the topology of the map, including composite layers.
+    """
+    db = setup_database(project)
+    with schema_lock(db) as acquired:
+        if not acquired:
+            raise self.retry(countdown=lock_retry_delay)
+        _update(db, composite_layers=True)
+
+
+@app.task(bind=True, max_retries=lock_max_retries, lane="bulk")
+def setup_cdr_topology(self, project: str):
     """
-    Update the topology of the map.
+    Build the topology for a CriticalMAAS CDR map from its extracted polygons.
     """
-    pass
+    # The CDR procedures live with the command-line application
+    from mapboard.cli.criticalmaas import setup_topology
+
+    db = setup_database(project)
+    with schema_lock(db) as acquired:
+        if not acquired:
+            raise self.retry(countdown=lock_retry_delay)
+        setup_topology(db)
+
+
+@app.task(base=ProgressTask, lane="bulk")
+def ingest_map(slug: str, files: list[str], **kwargs):
+    """
+    Ingest vector files into the database, publishing progress events.
+    """
+    from pathlib import Path
+
+    from mapboard.cli.ingest import ingest_map
+
+    ingest_map(slug, [Path(f) for f in files], **kwargs)
+
+
+@app.task(base=ProgressTask, lane="bulk")
+def export_project(project: str, output: str, overwrite: bool = False):
+    """
+    Export a project to a Mapboard mobile package, publishing progress events.
+    """
+    from pathlib import Path
+
+    from mapboard.cli.mobile_export import export_database
+
+    export_database(project, Path(output), overwrite=overwrite)
+
+
+@app.task(base=ProgressTask, lane="bulk")
+def create_cdr_project(cog_id: str, system: str, system_version: str):
+    """
+    Create a Mapboard project for a CDR map, publishing progress events.
+    """
+    from mapboard.cli.criticalmaas import create
+
+    create(cog_id, system, system_version)
@@ -0,0 +1,70 @@
+import pytest
+
+P = pytest.importorskip("pandas")
+pytest.importorskip("shapely")
+copy_loader = pytest.importorskip("mapboard.cli.copy_loader")
+
+from mapboard.cli.copy_loader import _escape, _serialize, column_types
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("plain", "plain"),
+        ("back\\slash", "back\\\\slash"),
+        ("tab\there", "tab\\there"),
+        ("two\nlines", "two\\nlines"),
+        ("carriage\rreturn", "carriage\\rreturn"),
+        (12, "12"),
+    ],
+)
+def test_escape(value, expected):
+    assert _escape(value) == expected
+
+
+def test_serialize_text():
+    column = P.Series(["a\tb", None, "c"], dtype=object)
+    assert list(_serialize(column, 4326)) == ["a\\tb", "\\N", "c"]
+
+
+def test_serialize_numbers():
+    assert list(_serialize(P.Series([1, 2]), 4326)) == ["1", "2"]
+    floats = P.Series([1.5, None])
+    assert list(_serialize(floats, 4326)) == ["1.5", "\\N"]
+
+
+def test_serialize_booleans():
+    column = P.Series([True, False, None], dtype="boolean")
+    assert list(_serialize(column, 4326)) == ["t", "f", "\\N"]
+
+
+def test_serialize_geometry():
+    gpd = pytest.importorskip("geopandas")
+    from shapely.geometry import Point
+
+    column = gpd.GeoSeries([Point(1, 2), None])
+    values = list(_serialize(column, 4326))
+    # Hex EWKB of a little-endian point with an SRID
+    assert values[0].upper().startswith("0101000020E6100000")
+    assert values[1] == "\\N"
+
+
+def test_column_types():
+    df = P.DataFrame(
+        {
+            "name": ["a"],
+            "small": P.Series([1], dtype="int32"),
+            "big": P.Series([1], dtype="int64"),
+            "value": [1.5],
+            "flag": [True],
+            "time": P.to_datetime(["2024-01-01"]),
+        }
+    )
+    assert column_types(df) == {
+        "name": "text",
+        "small": "integer",
+        "big": "bigint",
+        "value": "double precision",
+        "flag": "boolean",
+        "time": "timestamp",
+    }
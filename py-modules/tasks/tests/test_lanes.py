@@ -0,0 +1,116 @@
+import pytest
+
+pytest.importorskip("celery")
+
+from celery import Celery
+from celery.signals import before_task_publish
+
+from mapboard.tasks.lanes import route_task
+
+
+@pytest.fixture
+def app():
+    app = Celery("test", broker="memory://")
+    app.conf.task_routes = (route_task,)
+    return app
+
+
+@pytest.fixture
+def published():
+    queues = []
+
+    def record(sender=None, routing_key=None, **kwargs):
+        queues.append(routing_key)
+
+    before_task_publish.connect(record, weak=False)
+    yield queues
+    before_task_publish.disconnect(record)
+
+
+def test_route_keyword_arguments(app, published):
+    """Tasks submitted with only keyword arguments are routed to their lane"""
+
+    @app.task(lane="maintenance")
+    def task(project: str):
+        pass
+
+    task.apply_async(kwargs=dict(project="test"))
+    assert published == ["maintenance"]
+
+
+def test_route_positional_arguments(app, published):
+    @app.task(lane="maintenance")
+    def task(project: str):
+        pass
+
+    task.apply_async(args=("test",))
+    assert published == ["maintenance"]
+
+
+def test_route_expensive_task_to_bulk_lane(app, published):
+    @app.task(lane="interactive")
+    def task(project: str, cost: int = None):
+        pass
+
+    task.apply_async(kwargs=dict(project="test", cost=10**9))
+    assert published == ["bulk"]
+
+
+def test_interactive_without_cost(app, published):
+    """Tasks without a cost hint stay in their declared lane"""
+
+    @app.task(lane="interactive")
+    def task(project: str, cost: int = None):
+        pass
+
+    task.apply_async(kwargs=dict(project="test"))
+    assert published == ["interactive"]
+
+
+class Session:
+    def close(self):
+        pass
+
+
+class Client:
+    session = Session()
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    """Submissions of topology updates, with the number of stale lines to report"""
+    tasks = pytest.importorskip("mapboard.tasks.tasks")
+    calls = []
+    monkeypatch.setattr(tasks, "setup_database", lambda project: Client())
+    monkeypatch.setattr(tasks, "get_message_queue", lambda: None)
+    monkeypatch.setattr(
+        tasks,
+        "submit_once",
+        lambda task, queue, **kwargs: calls.append((task, kwargs)),
+    )
+
+    def submit(n_stale: int):
+        monkeypatch.setattr(
+            tasks, "count_stale_linework", lambda db, limit: min(n_stale, limit)
+        )
+        tasks.submit_topology_update("test")
+        task, kwargs = calls[-1]
+        return route_task(task.name, None, kwargs, {}, task=task)
+
+    return submit
+
+
+def test_large_update_routed_to_bulk_lane(submitted):
+    assert submitted(10**6) == {"queue": "bulk"}
+
+
+def test_small_update_stays_interactive(submitted):
+    assert submitted(10) == {"queue": "interactive"}
+
+
+def test_cost_does_not_change_idempotency_key():
+    task_runner = pytest.importorskip("mapboard.core.task_runner")
+
+    key = task_runner.idempotency_key
+    assert key("task", dict(project="a", cost=1)) == key("task", dict(project="a"))
+    assert key("task", dict(project="a")) != key("task", dict(project="b"))
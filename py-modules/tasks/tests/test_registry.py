@@ -0,0 +1,79 @@
+import pytest
+
+registry = pytest.importorskip("mapboard.core.registry")
+
+LRUCache = registry.LRUCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire():
+    clock = Clock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set("a", 1)
+    clock.now = 9.9
+    assert cache.get("a") == 1
+    clock.now = 10.0
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_reads_dont_extend_ttl():
+    clock = Clock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set("a", 1)
+    clock.now = 5.0
+    cache.get("a")
+    clock.now = 10.0
+    assert cache.get("a", "missing") == "missing"
+
+
+def test_without_ttl():
+    clock = Clock()
+    cache = LRUCache(ttl=None, clock=clock)
+    cache.set("a", 1)
+    clock.now = 10**9
+    assert cache.get("a") == 1
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Reading "a" makes "b" the least recently used
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_set_refreshes_entry():
+    clock = Clock()
+    cache = LRUCache(maxsize=2, ttl=10, clock=clock)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    clock.now = 5.0
+    cache.set("a", 3)
+    cache.set("c", 4)
+    assert cache.get("b") is None
+    clock.now = 14.0
+    assert cache.get("a") == 3
+
+
+def test_discard_and_clear():
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.discard("a")
+    cache.discard("missing")
+    assert cache.get("a") is None
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+scheduler = pytest.importorskip("mapboard.core.workers.scheduler")
+
+DirtyRegion = scheduler.DirtyRegion
+TopologyScheduler = scheduler.TopologyScheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def sched(clock):
+    return TopologyScheduler(quiet_period=2.0, max_delay=30.0, clock=clock)
+
+
+def change(table="linework", ids=(1,), **kwargs):
+    return dict(
+        type="feature-change", schema="test", table=table, ids=list(ids), **kwargs
+    )
+
+
+def test_debounce(sched, clock):
+    """A schema is only due once it has been quiet for the quiet period"""
+    sched.enqueue("a", change())
+    clock.now = 1.0
+    sched.enqueue("a", change())
+    clock.now = 2.5
+    assert sched.ready() == []
+    clock.now = 3.0
+    assert sched.ready() == ["a"]
+    assert sched.pending["a"].n_events == 2
+
+
+def test_max_delay(sched, clock):
+    """A schema with a steady stream of events is updated after the maximum delay"""
+    for t in range(30):
+        clock.now = float(t)
+        sched.enqueue("a", change())
+        assert sched.ready() == []
+    clock.now = 30.0
+    assert sched.ready() == ["a"]
+
+
+def test_ready_oldest_first(sched, clock):
+    sched.enqueue("b", change())
+    clock.now = 1.0
+    sched.enqueue("a", change())
+    clock.now = 10.0
+    assert sched.ready() == ["b", "a"]
+
+
+def test_exclude_in_progress(sched, clock):
+    """Schemas with an update in progress are neither ready nor waited for"""
+    sched.enqueue("a", change())
+    clock.now = 1.0
+    sched.enqueue("b", change())
+    clock.now = 10.0
+    assert sched.ready(exclude={"a"}) == ["b"]
+    assert sched.next_due(exclude={"a"}) == 3.0
+    assert sched.next_due(exclude={"a", "b"}) is None
+
+
+def test_pop(sched, clock):
+    sched.enqueue("a", change())
+    item = sched.pop("a")
+    assert item.n_events == 1
+    assert "a" not in sched.pending
+    assert sched.next_due() is None
+
+
+def test_wait_wakes_on_event(sched):
+    async def run():
+        waiter = asyncio.create_task(sched.wait())
+        await asyncio.sleep(0)
+        sched.enqueue("a", change())
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(run())
+
+
+def test_region_linework_only():
+    region = DirtyRegion()
+    region.add_event(change(ids=[1, 2]))
+    region.add_event(change(ids=[3]))
+    assert region.linework == {1, 2, 3}
+    assert region.linework_only
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        change(table="polygon"),
+        change(op="DELETE"),
+        change(attributes=True),
+        # Large statements don't list their ids
+        dict(type="feature-change", schema="test", table="linework", ids=None),
+    ],
+)
+def test_region_needs_full_update(event):
+    region = DirtyRegion()
+    region.add_event(change())
+    region.add_event(event)
+    assert not region.linework_only
+
+
+def test_region_merge():
+    a = DirtyRegion()
+    a.add_event(change(ids=[1]))
+    b = DirtyRegion()
+    b.add_event(change(table="polygon", ids=[2]))
+    a.merge(b)
+    assert a.linework == {1}
+    assert a.polygon == {2}
+    assert not a.linework_only
+
+
+def test_region_ignores_schema_only_events():
+    """Schema-only events from the topology manager still allow skipping the update"""
+    region = DirtyRegion()
+    region.add_event(dict(schema="test"))
+    region.add_event(change(ids=[1]))
+    region.add_event(dict(schema="test"))
+    assert region.linework_only
+
+
+@pytest.mark.parametrize(
+    "events",
+    [
+        # Nothing says what changed
+        [dict(schema="test")],
+        [change(), dict(type="catch-up", schema="test")],
+        [dict(type="restored", schema="test"), change()],
+    ],
+)
+def test_region_without_details_needs_full_update(events):
+    region = DirtyRegion()
+    for event in events:
+        region.add_event(event)
+    assert not region.linework_only
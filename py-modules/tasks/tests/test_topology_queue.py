@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Timer
+
+import pytest
+
+queue = pytest.importorskip("mapboard.core.workers.queue")
+
+QueueWriter = queue.QueueWriter
+
+
+class Queue:
+    """Records batches of keys, optionally blocking or failing"""
+
+    def __init__(self):
+        self.batches = []
+        self.unblock = Event()
+        self.unblock.set()
+        self.fail = False
+
+    def enqueue_many(self, keys):
+        self.unblock.wait(5)
+        if self.fail:
+            raise RuntimeError("unavailable")
+        self.batches.append(set(keys))
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield executor
+
+
+def test_batches_keys_added_while_writing(executor):
+    q = Queue()
+    q.unblock.clear()
+    writer = QueueWriter(q, executor)
+    writer.add(("db", "a"))
+    writer.add(("db", "b"))
+    writer.add(("db", "c"))
+    q.unblock.set()
+    assert writer.flush(("db", "a"))
+    # Wait for the next batch
+    executor.submit(lambda: None).result()
+    assert q.batches[0] == {("db", "a")}
+    # Keys added during the first write are written together
+    assert q.batches[1] == {("db", "b"), ("db", "c")}
+
+
+def test_flush_waits_for_write(executor):
+    q = Queue()
+    q.unblock.clear()
+    writer = QueueWriter(q, executor)
+    writer.add(("db", "a"))
+    Timer(0.1, q.unblock.set).start()
+    assert writer.flush(("db", "a"))
+    assert q.batches == [{("db", "a")}]
+
+
+def test_failed_keys_are_retried(executor):
+    q = Queue()
+    q.fail = True
+    writer = QueueWriter(q, executor)
+    writer.add(("db", "a"))
+    assert not writer.flush(("db", "a"))
+
+    writer.add(("db", "b"))
+    q.fail = False
+    writer.add(("db", "c"))
+    executor.submit(lambda: None).result()
+    assert writer.flush(("db", "c"))
+    assert set().union(*q.batches) == {("db", "a"), ("db", "b"), ("db", "c")}
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+topology = pytest.importorskip("mapboard.core.workers.topology")
+
+from mapboard.core.workers.scheduler import DirtyRegion, TopologyScheduler
+
+
+class Session:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Client:
+    def __init__(self):
+        self.session = Session()
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    calls = []
+    monkeypatch.setattr(topology, "_update", lambda db: calls.append(db))
+    return calls
+
+
+def linework_edit(*events):
+    region = DirtyRegion()
+    for event in events:
+        region.add_event(event)
+    return region
+
+
+change = dict(type="feature-change", schema="test", table="linework", ids=[1])
+
+
+def test_linework_only_edit_skips_update(monkeypatch, updates):
+    monkeypatch.setattr(topology, "has_stale_linework", lambda db, ids: False)
+    db = Client()
+    # Accompanied by the topology manager's schema-only event
+    topology.run_update(db, linework_edit(dict(schema="test"), change))
+    assert updates == []
+    assert db.session.closed
+
+
+def test_stale_linework_runs_update(monkeypatch, updates):
+    monkeypatch.setattr(topology, "has_stale_linework", lambda db, ids: True)
+    db = Client()
+    topology.run_update(db, linework_edit(change))
+    assert updates == [db]
+
+
+def test_schema_only_event_runs_update(monkeypatch, updates):
+    def has_stale_linework(db, ids):
+        raise AssertionError("should not be checked")
+
+    monkeypatch.setattr(topology, "has_stale_linework", has_stale_linework)
+    db = Client()
+    topology.run_update(db, linework_edit(dict(schema="test")))
+    assert updates == [db]
+
+
+def test_unknown_project_is_dropped(monkeypatch):
+    """An update for a project that can't be looked up doesn't stop the watcher"""
+    dropped = []
+
+    def get_client(database, data_schema):
+        raise LookupError("No such project")
+
+    monkeypatch.setattr(topology, "get_client", get_client)
+    monkeypatch.setattr(topology.work_queue, "drop", lambda *key: dropped.append(key))
+
+    scheduler = TopologyScheduler(quiet_period=0, max_delay=0)
+    scheduler.enqueue(("db", "gone"), dict(schema="gone"))
+
+    async def run():
+        topology._start_updates(scheduler, None, workers=2)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert dropped == [("db", "gone")]
+    assert scheduler.pending == {}
+    assert ("db", "gone") not in topology.update_in_progress.get()